@@ -1,15 +1,22 @@
 import asyncio
-from pyrogram import Client, filters, errors
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, ChatMember
+from pyrogram import Client, filters, errors, idle
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, ChatMember, ChatMemberUpdated, Document, CallbackQuery
 from pyrogram.enums import ChatMemberStatus, MessageMediaType
 import time
 import os
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from typing import Dict, Set, Optional, Deque, Tuple, List
-import random
-import string
+import json
+from collections import defaultdict, deque, OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+import heapq
+import math
+from typing import Dict, Set, Optional, Deque, Tuple, List, Callable, Awaitable
+import secrets
+import struct
+import itertools
 import aiohttp
+from cachetools import TTLCache
+import keep_alive
 import logging
 from asyncio import Queue
 
@@ -32,178 +39,714 @@ except (ValueError, TypeError) as e:
 app = Client("file-request-bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # Data storage
-verified_users: Dict[int, float] = defaultdict(float)  # user_id: verification timestamp
 db_channels: Set[int] = set()  # Dynamic DB channels
 force_sub_channels: Set[int] = set()  # Forced subscription channels
-message_pairs: Dict[int, tuple] = {}  # chat_id: (request_msg_id, response_msg_id)
+message_pairs: Dict[int, tuple] = {}  # chat_id: (request_msg_id, response_msg_id, created_at)
 admin_pending_action: Dict[int, str] = {}  # user_id: pending admin action
 admin_batch_keywords: Dict[int, str] = {}  # user_id: batch keyword (for genbatch/editbatch)
-batches: Dict[str, Dict] = {}  # keyword: {"channel_id": int, "msg_ids": List[int], "start_id": str}
+batches: Dict[str, Dict] = {}  # keyword: {"channel_id": int, "msg_ids": List[int], "files": List[dict], "start_id": str}
 batch_start_ids: Dict[str, str] = {}  # keyword: start_id (for logging)
+_batch_trigram_index: Dict[str, Set[str]] = defaultdict(set)  # 3-gram: batch keywords containing it
+_short_batch_keywords: Set[str] = set()  # Batch keywords too short to have a 3-gram
 admin_list: Set[int] = {ADMIN_ID}  # Set of admin IDs (starting with the main admin)
-log_channel: Optional[int] = None  # Log channel ID (set by admin)
-user_search_history: Dict[int, Deque[Tuple[str, float]]] = defaultdict(lambda: deque(maxlen=5))  # user_id: [(query, timestamp)]
-start_ids: Dict[int, str] = {}  # user_id: start_id
-user_search_counts: Dict[int, int] = defaultdict(int)  # user_id: number of searches
-search_cache: Dict[int, List[dict]] = {}  # chat_id: cached search results (temporary)
-search_cache_expiry: Dict[int, float] = {}  # chat_id: cache expiry timestamp
+_state: Dict[str, Optional[int]] = {"log_channel": None}  # Mutable runtime settings (log channel ID, set by admin)
+user_search_history: TTLCache = TTLCache(maxsize=10_000, ttl=86_400)  # user_id: deque([(query, timestamp)]), dropped after a day of inactivity
+start_ids: TTLCache = TTLCache(maxsize=10_000, ttl=86_400)  # user_id: start_id, dropped after a day
+user_search_counts: TTLCache = TTLCache(maxsize=10_000, ttl=86_400)  # user_id: number of searches, dropped after a day of inactivity
 custom_caption_format: str = "file \n📜 {filename and size} \nuploaded: \n@bot_paiyan official"  # Customizable caption format
+_channels_cache: Dict[str, object] = {"v": None, "dirty": True, "version": 0}  # Memoized db_channels | force_sub_channels
+_sub_kb_cache: Dict[str, object] = {"version": -1, "markup": None}  # Subscription keyboard built for a channels version
+_join_urls: Dict[int, str] = {}  # channel_id: "Join Channel" URL
 
 # Constants
 SEARCH_LIMIT = 50
+SEARCH_CONCURRENCY = 8  # Max DB channels searched at the same time
 VERIFICATION_DURATION = 3600  # 1 hour for GPLinks usage
 PAGE_SIZE = 10  # Results per page
 DELETE_DELAY = 600  # 10 minutes in seconds
 ADMIN_PASSWORD = "12122"
+PASSWORD_PROMPT = "🔒 Please enter the admin password to proceed:"
+ADMIN_COMMANDS = frozenset({
+    "add_db", "add_sub", "genbatch", "editbatch", "caption", "channels", "stats", "user_stats",
+    "broadcast", "remove_channel", "admin_list", "set_logchannel", "set_rate_limit", "clear_logs"
+})
+NON_QUERY_COMMANDS = frozenset({"start", "help", "feedback"}) | ADMIN_COMMANDS
+ADMIN_STATUSES = frozenset({ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+MEMBER_STATUSES = frozenset({ChatMemberStatus.MEMBER}) | ADMIN_STATUSES  # Statuses that count as joined
+BROADCAST_BLOCKED_TEXTS = frozenset({"/start", "/help", "/feedback"}) | ADMIN_COMMANDS  # Never broadcast these as-is
+ADMIN_PROMPT_LOG = "Admin {uid} initiated {label}: {data}"
 RATE_LIMIT_WINDOW = 30  # Time window in seconds for rate limiting
 RATE_LIMIT_MAX_MESSAGES = 20  # Max messages allowed in the window (configurable)
-MIN_MESSAGE_DELAY = 1.0  # Minimum delay between messages (configurable)
+MIN_MESSAGE_DELAY = 1.0  # Minimum delay between messages to the same chat (configurable)
+MAX_RATE_LIMIT_MESSAGES = 1000  # Upper bound /set_rate_limit accepts for max_messages
+MAX_MESSAGE_DELAY = 60.0  # Upper bound /set_rate_limit accepts for min_delay (seconds)
+BROADCAST_SILENT = True  # Send broadcasts without notifications or link previews (configurable)
+_SILENT_FLAGS = {"1": True, "on": True, "yes": True, "0": False, "off": False, "no": False}  # silent_broadcast values for /set_rate_limit
+BROADCAST_CONCURRENCY = 10  # Max broadcast sends in flight at the same time
 CACHE_DURATION = 300  # 5 minutes for search result caching
+JANITOR_INTERVAL = 60  # Seconds between sweeps for stale per-chat state
+BATCHES_FILE = os.getenv("BATCHES_FILE", "batches.json")  # Where batches are persisted across restarts
+KEEP_ALIVE_PORT = os.getenv("PORT")  # Keep-alive HTTP server port; the server is off when unset
+ADMIN_MENU_TEXT = (
+    "👨‍💼 Admin Menu 🌟\n"
+    "━━━━━━━━━━━━━━\n"
+    "Available Commands:\n"
+    "/add_db - Add a DB channel 📚\n"
+    "/add_sub - Add a subscription channel 📢\n"
+    "/genbatch - Generate a new batch of files 🎁\n"
+    "/editbatch - Edit an existing batch of files ✏️\n"
+    "/caption - Set custom caption format for files 📜\n"
+    "/channels - List all configured channels 📋\n"
+    "/stats - View bot statistics 📊\n"
+    "/user_stats - View user activity statistics 📈\n"
+    "/broadcast - Broadcast a message 📣\n"
+    "/remove_channel - Remove a channel 🗑️\n"
+    "/admin_list - View admin list 👥\n"
+    "/set_logchannel - Set a log channel 📝\n"
+    "/set_rate_limit - Adjust rate limiting and silent broadcasts ⚙️\n"
+    "/clear_logs - Clear logs in log channel 🧹\n"
+    "━━━━━━━━━━━━━━\n"
+    "Enter the command to proceed (password required). 🔒"
+)
+WELCOME_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
+    [InlineKeyboardButton("🕒 Recent Searches", callback_data="view_history")]
+])
+# Callback data that asks an admin for the password, by exact value and by prefix: log label
+ADMIN_PROMPT_EXACT = {"add_db": "action", "add_sub": "action", "stats": "action", "remove_channel": "action"}
+ADMIN_PROMPT_PREFIXES = {
+    "rm_db_": "remove DB channel action",
+    "rm_sub_": "remove subscription channel action",
+    "add_db_forward_": "add DB channel action",
+    "add_sub_forward_": "add subscription channel action",
+}
+_DB_LABEL, _SUB_LABEL = "DB Channel", "Subscription Channel"  # Channel kind button labels
+_FILE_CALLBACK = struct.Struct(">qIH")  # Get/share button payload: channel_id, msg_id, tag
+SHORT_LINK_CACHE_SIZE = 2048  # Max cached shortened URLs
+SHORT_LINK_TTL = 12 * 3600  # 12 hours for a cached shortened URL
+SHORT_LINK_FAILURE_TTL = 60  # Back off from GPLinks for 1 minute after a failure
+PRIVILEGE_CACHE_TTL = 300  # 5 minutes for cached bot privilege checks
+SUBSCRIPTION_CACHE_TTL = 60  # 1 minute for remembered channel memberships
+SENDER_IDLE_TIMEOUT = 300  # Idle per-destination send workers are retired after 5 minutes
+LOG_IDS_TRACKED = 1000  # Recent log channel message IDs remembered for /clear_logs
+DELETE_MESSAGES_CHUNK = 100  # Max message IDs per delete_messages call
+USER_STATS_PAGE_SIZE = 50  # Users per /user_stats page
+SENDER_WORKERS = 4  # Parallel workers, each draining its own shard of the message queue
+QUEUE_BATCH_SIZE = 32  # Max queued sends a worker dispatches together
+QUEUE_BATCH_WINDOW = 0.005  # Seconds a worker waits for a burst of sends to accumulate
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Seconds to let queued sends finish on shutdown before cancelling them
 
 # Dynamic rate limiting
 message_timestamps: Deque[float] = deque(maxlen=RATE_LIMIT_MAX_MESSAGES)
-message_queue: Queue = Queue()
-is_sending = False
-
-# Helper: Dynamic rate limiter to prevent flooding
+_rate_lock = asyncio.Lock()  # Makes the global limiter's check-and-record atomic across workers
+message_queues: List[Queue] = [Queue() for _ in range(SENDER_WORKERS)]  # Send queue shards; a chat always maps to the same shard
+_sender_tasks: List[asyncio.Task] = []  # Permanent message queue workers (started in main)
+_chat_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)  # chat_id: serializes sends to one chat
+_chat_last_sent: Dict[int, float] = {}  # chat_id: timestamp of the last message sent there
+senders: Dict[int, Queue] = {}  # chat_id: dedicated send queue (one worker per destination)
+_destination_tasks: Dict[int, asyncio.Task] = {}  # chat_id: worker draining that destination's queue
+_http_session: Optional[aiohttp.ClientSession] = None  # Shared HTTP session (created lazily)
+_priv_cache: Dict[Tuple[int, bool], Tuple[bool, float]] = {}  # (chat_id, require_admin): (allowed, expiry)
+_sub_member_cache: TTLCache = TTLCache(maxsize=100_000, ttl=SUBSCRIPTION_CACHE_TTL)  # (user_id, channel_id): confirmed membership
+_sub_inflight: Dict[int, asyncio.Task] = {}  # user_id: subscription check in progress
+short_link_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # long_url: (short_url, expiry), LRU order
+_callback_tags = itertools.count(secrets.randbits(16))  # Tags keeping file button callback data distinct (not secret, seeded once)
+_short_link_inflight: Dict[str, asyncio.Task] = {}  # long_url: GPLinks request in progress
+search_cache: TTLCache = TTLCache(maxsize=1024, ttl=CACHE_DURATION)  # chat_id: cached search results (temporary)
+search_pages_cache: TTLCache = TTLCache(maxsize=1024, ttl=CACHE_DURATION)  # chat_id: prebuilt keyboard per results page
+verified_users: TTLCache = TTLCache(maxsize=100_000, ttl=VERIFICATION_DURATION)  # user_id: verification timestamp, dropped once verification lapses
+_log_msg_ids: Deque[int] = deque(maxlen=LOG_IDS_TRACKED)  # IDs of messages sent to the current log channel
+_user_stats_snapshot: List[Tuple[int, int]] = []  # Sorted (user_id, searches) used for /user_stats paging
+_background_tasks: List[asyncio.Task] = []  # Long-running maintenance tasks (started in main)
+_delete_timers: Dict[int, asyncio.Task] = {}  # chat_id: pending delete_messages_later task
+_batch_edits_cleared: Set[int] = set()  # Admins whose current /editbatch already replaced the old files
+_pair_heap: List[Tuple[float, int]] = []  # (created_at, chat_id) min-heap over message_pairs for the janitor
+
+# Helper: Dynamic global rate limiter to prevent flooding
 async def rate_limit_message():
-    global RATE_LIMIT_MAX_MESSAGES, MIN_MESSAGE_DELAY
-    now = time.time()
-
-    # Clean up old timestamps
-    while message_timestamps and now - message_timestamps[0] > RATE_LIMIT_WINDOW:
-        message_timestamps.popleft()
-
-    # Check if we're within the rate limit
-    if len(message_timestamps) >= RATE_LIMIT_MAX_MESSAGES:
-        wait_time = RATE_LIMIT_WINDOW - (now - message_timestamps[0])
-        if wait_time > 0:
-            logger.info(f"Rate limit hit, waiting {wait_time:.2f} seconds")
-            await asyncio.sleep(wait_time)
+    async with _rate_lock:
+        now = time.time()
+
+        # Clean up old timestamps
+        while message_timestamps and now - message_timestamps[0] > RATE_LIMIT_WINDOW:
+            message_timestamps.popleft()
+
+        # Check if we're within the rate limit
+        if len(message_timestamps) >= RATE_LIMIT_MAX_MESSAGES:
+            wait_time = RATE_LIMIT_WINDOW - (now - message_timestamps[0])
+            if wait_time > 0:
+                logger.info("Rate limit hit, waiting %.2f seconds", wait_time)
+                await asyncio.sleep(wait_time)
+            now = time.time()
 
-    # Add the current timestamp
-    message_timestamps.append(now)
+        # Add the current timestamp
+        message_timestamps.append(now)
 
-    # Ensure a minimum delay between messages
-    if message_timestamps and len(message_timestamps) > 1:
-        last_time = message_timestamps[-2]
-        time_since_last = now - last_time
+# Helper: Per-chat rate limiter, keeps MIN_MESSAGE_DELAY between messages to the same chat
+async def rate_limit_chat(chat_id: int):
+    last_time = _chat_last_sent.get(chat_id)
+    if last_time is not None:
+        time_since_last = time.time() - last_time
         if time_since_last < MIN_MESSAGE_DELAY:
             await asyncio.sleep(MIN_MESSAGE_DELAY - time_since_last)
 
-# Helper: Message sending queue to prevent flooding
-async def send_message_queue(client: Client):
-    global is_sending
-    if is_sending:
-        return
-    is_sending = True
+# Helper: Resolve the chat a queued call targets (bound Message methods or a chat_id argument)
+def _target_chat_id(func, args) -> Optional[int]:
+    target = getattr(func, "__self__", None)
+    if isinstance(target, Message):
+        return target.chat.id
+    return next((arg for arg in args if isinstance(arg, int)), None)
+
+# Helper: Send one queued call under the per-chat and global rate limits, resolving its future
+async def _send_queued(chat_id: Optional[int], func, args, kwargs, future: asyncio.Future):
     try:
-        while not message_queue.empty():
+        while True:
             try:
-                func, args, kwargs = await message_queue.get()
-                await rate_limit_message()
-                await func(*args, **kwargs)
+                if chat_id is None:
+                    await rate_limit_message()
+                    result = await func(*args, **kwargs)
+                else:
+                    async with _chat_locks[chat_id]:
+                        await rate_limit_chat(chat_id)
+                        await rate_limit_message()
+                        result = await func(*args, **kwargs)
+                        _chat_last_sent[chat_id] = time.time()
+                break
             except errors.FloodWait as e:
-                logger.warning(f"FloodWait: Waiting for {e.value} seconds")
+                # Wait it out and send again, later sends to this chat stay queued behind this one
+                logger.warning("FloodWait for chat %s: Waiting for %s seconds", chat_id, e.value)
                 await asyncio.sleep(e.value)
-            except Exception as e:
-                logger.error(f"Error sending message: {str(e)}")
-            finally:
-                message_queue.task_done()
-    finally:
-        is_sending = False
-
-# Helper: Queue a message to be sent
-async def queue_message(func, *args, **kwargs):
-    await message_queue.put((func, args, kwargs))
-    asyncio.create_task(send_message_queue(app))
+        if not future.done():
+            future.set_result(result)
+    except Exception as e:
+        logger.error("Error sending message to chat %s: %s", chat_id, e)
+        if not future.done():
+            future.set_exception(e)
+            future.exception()  # Already logged; most callers never await the future, so don't warn about it
+
+# Helper: Send one chat's queued calls one after another, in queue order
+async def _send_chat_items(items: List[tuple]):
+    for item in items:
+        await _send_queued(*item)
+
+# Helper: Message queue worker, one per shard so unrelated chats don't block each other
+async def _sender_worker(queue: Queue):
+    while True:
+        batch = [await queue.get()]
+        # Let a burst (pagination, result rendering) accumulate, then dispatch it in one go
+        await asyncio.sleep(QUEUE_BATCH_WINDOW)
+        while len(batch) < QUEUE_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        # Different chats go out concurrently; each chat's sends keep their order
+        by_chat: Dict[Optional[int], List[tuple]] = defaultdict(list)
+        for item in batch:
+            by_chat[item[0]].append(item)
+        try:
+            await asyncio.gather(*(_send_chat_items(items) for items in by_chat.values()))
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+# Helper: Start the permanent message queue workers (one per shard)
+def start_sender_workers():
+    for queue in message_queues:
+        _sender_tasks.append(asyncio.create_task(_sender_worker(queue)))
+
+# Helper: Let queued sends finish (bounded by SHUTDOWN_DRAIN_TIMEOUT), then cancel every send worker
+async def stop_sender_workers():
+    queues = [*message_queues, *senders.values()]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in queues)), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Shutdown: %d queued sends dropped", sum(queue.qsize() for queue in queues))
+    tasks = [*_sender_tasks, *_destination_tasks.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _sender_tasks.clear()
+    _destination_tasks.clear()
+    senders.clear()
+
+# Helper: Queue a message to be sent, returns a future for the call's outcome
+async def queue_message(func, *args, **kwargs) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    chat_id = _target_chat_id(func, args)
+    # Every send to a chat lands on the same shard, so a single worker delivers them in order
+    message_queues[(chat_id or 0) % SENDER_WORKERS].put_nowait((chat_id, func, args, kwargs, future))
+    return future
+
+# Helper: Worker draining the send queue of a single destination
+async def _destination_worker(chat_id: int, queue: Queue):
+    while True:
+        try:
+            func, args, kwargs, future = await asyncio.wait_for(queue.get(), SENDER_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Retire idle workers so the table only holds recently used destinations
+            if queue.empty():
+                senders.pop(chat_id, None)
+                _destination_tasks.pop(chat_id, None)
+                return
+            continue
+        try:
+            while True:
+                try:
+                    # Same per-chat and global limits as the shared queue, so broadcasts can't outrun them
+                    async with _chat_locks[chat_id]:
+                        await rate_limit_chat(chat_id)
+                        await rate_limit_message()
+                        result = await func(*args, **kwargs)
+                        _chat_last_sent[chat_id] = time.time()
+                    break
+                except errors.FloodWait as e:
+                    # Only this destination backs off, other workers keep sending
+                    logger.warning("FloodWait for chat %s: Waiting for %s seconds", chat_id, e.value)
+                    await asyncio.sleep(e.value)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            logger.error("Error sending message to chat %s: %s", chat_id, e)
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            queue.task_done()
+
+# Helper: Queue a call on the send queue of a specific destination, returns a future for its outcome
+async def enqueue(chat_id: int, func, *args, **kwargs) -> asyncio.Future:
+    queue = senders.get(chat_id)
+    if queue is None:
+        queue = senders[chat_id] = Queue()
+        _destination_tasks[chat_id] = asyncio.create_task(_destination_worker(chat_id, queue))
+    future = asyncio.get_running_loop().create_future()
+    await queue.put((func, args, kwargs, future))
+    return future
+
+# Helper: Mark the memoized channel union stale (call after mutating db_channels/force_sub_channels)
+def invalidate_channels_cache():
+    _channels_cache["dirty"] = True
+    _channels_cache["version"] += 1
+
+# Helper: All DB and subscription channels, rebuilt only after a mutation
+def get_all_channels() -> frozenset:
+    if _channels_cache["dirty"]:
+        _channels_cache["v"] = frozenset(db_channels | force_sub_channels)
+        _channels_cache["dirty"] = False
+    return _channels_cache["v"]
+
+# Helper: Character 3-grams of a string
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Helper: Add a batch keyword to the trigram index (call when a batch is created)
+def index_batch_keyword(keyword: str):
+    grams = _trigrams(keyword)
+    if not grams:
+        _short_batch_keywords.add(keyword)
+    for gram in grams:
+        _batch_trigram_index[gram].add(keyword)
+
+# Helper: Remove a batch keyword from the trigram index (call when a batch is deleted)
+def unindex_batch_keyword(keyword: str):
+    _short_batch_keywords.discard(keyword)
+    for gram in _trigrams(keyword):
+        keywords = _batch_trigram_index.get(gram)
+        if keywords is not None:
+            keywords.discard(keyword)
+            if not keywords:
+                del _batch_trigram_index[gram]
+
+# Helper: Find a batch keyword that contains the query or is contained in it
+def find_batch_keyword(query: str) -> Optional[str]:
+    # Any keyword matching in either direction shares at least one 3-gram with the query
+    candidates = set(_short_batch_keywords)
+    for gram in _trigrams(query):
+        candidates.update(_batch_trigram_index.get(gram, ()))
+    matches = sorted(keyword for keyword in candidates if query in keyword or keyword in query)
+    return matches[0] if matches else None
+
+# Helper: Search result entry for a stored document
+def file_entry(doc: Document, msg_id: int, channel_id: int) -> dict:
+    return {
+        "file_name": doc.file_name or "Unnamed File",
+        "file_size": round(doc.file_size / (1024 * 1024), 2),
+        "file_id": doc.file_id,
+        "msg_id": msg_id,
+        "channel_id": channel_id
+    }
+
+# Helper: Write batches to disk so their file metadata survives a restart
+def save_batches():
+    tmp_path = f"{BATCHES_FILE}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(batches, f)
+        os.replace(tmp_path, BATCHES_FILE)
+    except OSError as e:
+        logger.error("Error saving batches to %s: %s", BATCHES_FILE, e)
+
+# Helper: Load batches written by save_batches and rebuild the keyword index
+def load_batches():
+    try:
+        with open(BATCHES_FILE, encoding="utf-8") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error("Error loading batches from %s: %s", BATCHES_FILE, e)
+        return
+    loaded = 0
+    for keyword, batch in saved.items():
+        # Skip hand-edited or truncated entries instead of failing startup on them
+        if not isinstance(batch, dict) or not isinstance(batch.get("msg_ids"), list) or "channel_id" not in batch:
+            logger.warning("Skipping malformed batch '%s' in %s", keyword, BATCHES_FILE)
+            continue
+        batch.setdefault("files", [])
+        batches[keyword] = batch
+        start_id = batch.get("start_id")
+        if start_id is not None:
+            batch_start_ids[keyword] = start_id
+        index_batch_keyword(keyword)
+        loaded += 1
+    logger.info("Loaded %d batches from %s", loaded, BATCHES_FILE)
+
+# Helper: Channel ID as it appears in t.me/c links (channel IDs are -100 followed by the peer ID)
+@lru_cache(maxsize=1024)
+def _link_channel_id(channel_id: int) -> str:
+    return str(-channel_id - 10**12) if channel_id < -10**12 else str(channel_id)
+
+# Helper: t.me/c link to a message in a channel
+def message_link(channel_id: int, msg_id: int) -> str:
+    return f"https://t.me/c/{_link_channel_id(channel_id)}/{msg_id}"
+
+# Helper: "Join Channel" URL for a channel (memoized per channel ID)
+def join_url(channel_id: int) -> str:
+    url = _join_urls.get(channel_id)
+    if url is None:
+        url = _join_urls[channel_id] = f"https://t.me/c/{_link_channel_id(channel_id)}"
+    return url
+
+# Helper: Forced-subscription keyboard, rebuilt only when the channel lists change
+def subscription_keyboard() -> InlineKeyboardMarkup:
+    if _sub_kb_cache["version"] != _channels_cache["version"]:
+        buttons = [[InlineKeyboardButton("Join Channel", url=join_url(ch))] for ch in force_sub_channels]
+        buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="check_sub")])
+        _sub_kb_cache["markup"] = InlineKeyboardMarkup(buttons)
+        _sub_kb_cache["version"] = _channels_cache["version"]
+    return _sub_kb_cache["markup"]
+
+# Helper: Callback data for a file button (kind "g" = get, "s" = share), IDs packed as hex
+def file_callback(kind: str, channel_id: int, msg_id: int) -> str:
+    return f"{kind}:{_FILE_CALLBACK.pack(channel_id, msg_id, next(_callback_tags) & 0xFFFF).hex()}"
+
+# Helper: Channel and message ID from a file button's callback data (also accepts the older get_/share_ form)
+def parse_file_callback(data: str) -> Tuple[int, int]:
+    if data[1] == ":":
+        channel_id, msg_id, _ = _FILE_CALLBACK.unpack(bytes.fromhex(data[2:]))
+        return channel_id, msg_id
+    _, channel_id, msg_id, _ = data.split("_", 3)
+    return int(channel_id), int(msg_id)
 
 # Helper: Generate dynamic ID for callbacks and start IDs
 def generate_dynamic_id(length: int = 10) -> str:
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    return secrets.token_urlsafe(length)[:length]
+
+# Helper: Shared HTTP session so all outgoing requests reuse one keep-alive connection pool
+async def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(total=5)
+        )
+    return _http_session
+
+# Helper: Close the shared HTTP session on shutdown
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+# Helper: Request a short link from GPLinks, returns None on failure
+async def _request_short_link(long_url: str) -> Optional[str]:
+    session = await get_http_session()
+    params = {"api": GPLINK_API_KEY, "url": long_url, "format": "text"}
+    try:
+        async with session.get("https://api.gplinks.in/api", params=params) as response:
+            if response.status == 200:
+                shortened_url = (await response.text()).strip()
+                logger.info("Shortened URL: %s", shortened_url)
+                return shortened_url
+            else:
+                logger.warning("GPLinks API failed with status %s", response.status)
+                return None
+    except Exception as e:
+        logger.error("Shorten link error: %s", e)
+        return None
+
+# Helper: Fetch a short link and store it in the cache (runs once per URL however many callers wait on it)
+async def _fetch_short_link(long_url: str) -> str:
+    try:
+        shortened_url = await _request_short_link(long_url)
+    finally:
+        _short_link_inflight.pop(long_url, None)
+    now = time.time()
+    if shortened_url is None:
+        short_link_cache[long_url] = (long_url, now + SHORT_LINK_FAILURE_TTL)
+    else:
+        short_link_cache[long_url] = (shortened_url, now + SHORT_LINK_TTL)
+    short_link_cache.move_to_end(long_url)
+    while len(short_link_cache) > SHORT_LINK_CACHE_SIZE:
+        short_link_cache.popitem(last=False)
+    return short_link_cache[long_url][0]
 
-# Helper: Shorten link using GPLinks
+# Helper: Shorten link using GPLinks (cached per URL, failures are cached briefly to avoid retry floods)
 async def shorten_link(long_url: str) -> str:
-    async with aiohttp.ClientSession() as session:
-        api_url = f"https://api.gplinks.in/api?api={GPLINK_API_KEY}&url={long_url}&format=text"
-        try:
-            async with session.get(api_url, timeout=5) as response:
-                if response.status == 200:
-                    shortened_url = (await response.text()).strip()
-                    logger.info(f"Shortened URL: {shortened_url}")
-                    return shortened_url
-                else:
-                    logger.warning(f"GPLinks API failed with status {response.status}")
-                    return long_url
-        except Exception as e:
-            logger.error(f"Shorten link error: {str(e)}")
-            return long_url
+    cached = short_link_cache.get(long_url)
+    if cached is not None and time.time() < cached[1]:
+        short_link_cache.move_to_end(long_url)
+        return cached[0]
+
+    # Concurrent misses for the same URL share one GPLinks request
+    task = _short_link_inflight.get(long_url)
+    if task is None:
+        task = _short_link_inflight[long_url] = asyncio.create_task(_fetch_short_link(long_url))
+    # Shielded so one cancelled caller doesn't cancel the request for the others
+    return await asyncio.shield(task)
+
+shorten_link.cache_clear = short_link_cache.clear
+
+# Helper: Send a log message and remember its ID so /clear_logs can delete it without scanning history
+async def _send_log_message(client: Client, chat_id: int, text: str):
+    sent = await client.send_message(chat_id, text)
+    if chat_id == _state["log_channel"]:
+        _log_msg_ids.append(sent.id)
 
 # Helper: Send log message to log channel if set
 async def log_to_channel(client: Client, message: str):
-    if log_channel is None:
+    ch = _state["log_channel"]
+    if ch is None:
         logger.warning("Log channel not set, cannot log message")
         return
     try:
-        await queue_message(client.send_message, log_channel, f"📋 Log: {message}")
-        logger.info(f"Logged to channel {log_channel}: {message}")
+        await queue_message(_send_log_message, client, ch, f"📋 Log: {message}")
+        logger.info("Logged to channel %s: %s", ch, message)
     except Exception as e:
-        logger.error(f"Failed to send log to channel {log_channel}: {e}")
+        logger.error("Failed to send log to channel %s: %s", ch, e)
+
+# Helper: Drop expired privilege cache entries (evict individually rather than clearing everything)
+def _prune_priv_cache(now: float):
+    for key in [key for key, (_, expiry) in _priv_cache.items() if expiry <= now]:
+        del _priv_cache[key]
 
-# Helper: Check if the bot has sufficient privileges in a chat
+# Helper: Forget cached privileges for a chat (e.g. after the bot's membership changed)
+def invalidate_privileges(chat_id: int):
+    _priv_cache.pop((chat_id, True), None)
+    _priv_cache.pop((chat_id, False), None)
+
+# Helper: Check if the bot has sufficient privileges in a chat (cached for PRIVILEGE_CACHE_TTL)
 async def check_bot_privileges(client: Client, chat_id: int, require_admin: bool = True) -> bool:
+    key = (chat_id, require_admin)
+    now = time.time()
+    cached = _priv_cache.get(key)
+    if cached is not None and now < cached[1]:
+        return cached[0]
+
+    allowed = await _fetch_bot_privileges(client, chat_id, require_admin)
+    if allowed is None:  # Transient error, don't cache
+        return False
+    _prune_priv_cache(now)
+    _priv_cache[key] = (allowed, now + PRIVILEGE_CACHE_TTL)
+    return allowed
+
+# Helper: Query the bot's privileges in a chat, returns None on unexpected errors
+async def _fetch_bot_privileges(client: Client, chat_id: int, require_admin: bool) -> Optional[bool]:
     try:
         bot_member: ChatMember = await client.get_chat_member(chat_id, "me")
         status = bot_member.status
         if not require_admin:
-            return status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
-        if status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+            return status in MEMBER_STATUSES
+        if status not in ADMIN_STATUSES:
             await log_to_channel(client, f"Bot lacks admin privileges in chat {chat_id}: Status is {status}")
             return False
-        if isinstance(bot_member, ChatMember) and hasattr(bot_member, 'privileges'):
-            if bot_member.privileges and not bot_member.privileges.can_post_messages:
-                await log_to_channel(client, f"Bot lacks post message privileges in chat {chat_id}")
-                return False
+        privileges = bot_member.privileges
+        if privileges and not privileges.can_post_messages:
+            await log_to_channel(client, f"Bot lacks post message privileges in chat {chat_id}")
+            return False
         return True
     except errors.UserNotParticipant:
         await log_to_channel(client, f"Bot is not a participant in chat {chat_id}")
         return False
     except Exception as e:
         await log_to_channel(client, f"Error checking bot privileges in chat {chat_id}: {str(e)}")
-        logger.error(f"Error checking bot privileges in chat {chat_id}: {e}")
-        return False
+        logger.error("Error checking bot privileges in chat %s: %s", chat_id, e)
+        return None
 
 # Helper: Check subscription status (only for private chats)
 async def check_subscription(client: Client, user_id: int, chat_id: int) -> bool:
     if chat_id < 0:  # Skip subscription check in groups
         return True
-    for channel_id in force_sub_channels:
-        try:
-            member = await client.get_chat_member(channel_id, user_id)
-            if member.status not in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-                return False
-        except (errors.UserNotParticipant, errors.PeerIdInvalid):
-            return False
-        except Exception as e:
-            await log_to_channel(client, f"Subscription check error for user {user_id}: {str(e)}")
-            logger.error(f"Subscription check error: {e}")
-            return False
-    return True
+    channels = [ch for ch in force_sub_channels if (user_id, ch) not in _sub_member_cache]
+    if not channels:
+        return True
+
+    # Simultaneous checks for the same user (e.g. rapid get_ clicks) share one round of queries
+    task = _sub_inflight.get(user_id)
+    if task is None:
+        task = _sub_inflight[user_id] = asyncio.create_task(_query_subscription(client, user_id, channels))
+    return await asyncio.shield(task)
+
+# Helper: Query the user's membership in the given channels concurrently, remembering confirmed ones
+async def _query_subscription(client: Client, user_id: int, channels: List[int]) -> bool:
+    try:
+        members = await asyncio.gather(*(client.get_chat_member(ch, user_id) for ch in channels), return_exceptions=True)
+    finally:
+        _sub_inflight.pop(user_id, None)
+    subscribed = True
+    for channel_id, member in zip(channels, members):
+        if isinstance(member, (errors.UserNotParticipant, errors.PeerIdInvalid)):
+            subscribed = False
+        elif isinstance(member, Exception):
+            await log_to_channel(client, f"Subscription check error for user {user_id}: {str(member)}")
+            logger.error("Subscription check error: %s", member)
+            subscribed = False
+        elif member.status not in MEMBER_STATUSES:
+            subscribed = False
+        else:
+            _sub_member_cache[(user_id, channel_id)] = True
+    return subscribed
 
 # Helper: Delete messages after a delay
 async def delete_messages_later(client: Client, chat_id: int, request_msg_id: int, response_msg_id: int):
     try:
         await asyncio.sleep(DELETE_DELAY)
-        await client.delete_messages(chat_id, [request_msg_id, response_msg_id])
+        # Shielded so a cancellation can't leave the pair half-deleted
+        await asyncio.shield(client.delete_messages(chat_id, [request_msg_id, response_msg_id]))
         await log_to_channel(client, f"Deleted messages in chat {chat_id}: {request_msg_id}, {response_msg_id}")
-        logger.info(f"Deleted messages in chat {chat_id}: {request_msg_id}, {response_msg_id}")
+        logger.info("Deleted messages in chat %s: %s, %s", chat_id, request_msg_id, response_msg_id)
+    except asyncio.CancelledError:
+        raise  # Rescheduled or shutting down: the chat's state belongs to whoever cancelled us
     except Exception as e:
         await log_to_channel(client, f"Error deleting messages in chat {chat_id}: {str(e)}")
-        logger.error(f"Error deleting messages in chat {chat_id}: {e}")
-    finally:
-        message_pairs.pop(chat_id, None)
-        search_cache.pop(chat_id, None)
-        search_cache_expiry.pop(chat_id, None)
+        logger.error("Error deleting messages in chat %s: %s", chat_id, e)
+    message_pairs.pop(chat_id, None)
+    search_cache.pop(chat_id, None)
+    search_pages_cache.pop(chat_id, None)
+    if _delete_timers.get(chat_id) is asyncio.current_task():
+        del _delete_timers[chat_id]
+
+# Helper: Schedule deletion of a request/response pair, replacing any pending timer for the chat
+def schedule_message_deletion(client: Client, chat_id: int, request_msg_id: int, response_msg_id: int):
+    previous = _delete_timers.pop(chat_id, None)
+    if previous is not None:
+        previous.cancel()
+    _delete_timers[chat_id] = asyncio.create_task(delete_messages_later(client, chat_id, request_msg_id, response_msg_id))
+
+# Helper: Cancel pending deletion timers and maintenance tasks and wait for them to finish
+async def cancel_pending_tasks():
+    tasks = [*_delete_timers.values(), *_background_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _delete_timers.clear()
+    _background_tasks.clear()
+
+# Helper: Remember a request/response pair for a chat (the janitor finds it again via _pair_heap)
+def track_message_pair(chat_id: int, request_msg_id: int, response_msg_id: int):
+    created_at = time.time()
+    message_pairs[chat_id] = (request_msg_id, response_msg_id, created_at)
+    heapq.heappush(_pair_heap, (created_at, chat_id))
+
+# Helper: Forget per-chat send state for chats that are past their send delay and not sending right now
+def prune_chat_state():
+    cutoff = time.time() - MIN_MESSAGE_DELAY
+    for chat_id in [cid for cid, last in _chat_last_sent.items() if last < cutoff]:
+        lock = _chat_locks.get(chat_id)
+        if lock is None or not lock.locked():
+            del _chat_last_sent[chat_id]
+            _chat_locks.pop(chat_id, None)
+    # Locks for sends that failed before recording a timestamp
+    for chat_id in [cid for cid, lock in _chat_locks.items() if cid not in _chat_last_sent and not lock.locked()]:
+        del _chat_locks[chat_id]
+
+# Helper: Periodically evict message pairs whose deletion never ran, expired cache entries and idle chat send state
+async def _janitor():
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        cutoff = time.time() - DELETE_DELAY * 2
+        # Only the oldest pairs are looked at; heap entries for pairs already replaced or removed are skipped
+        while _pair_heap and _pair_heap[0][0] < cutoff:
+            created_at, chat_id = heapq.heappop(_pair_heap)
+            pair = message_pairs.get(chat_id)
+            if pair is not None and pair[2] == created_at:
+                del message_pairs[chat_id]
+                logger.info("Janitor evicted stale message pair in chat %s", chat_id)
+        # TTLCache only expires on access, so drop entries for chats and users that went quiet
+        for cache in (search_cache, search_pages_cache, verified_users, _sub_member_cache, start_ids, user_search_history, user_search_counts):
+            cache.expire()
+        prune_chat_state()
+
+# Filter: Text that isn't one of the bot's own commands (a single set lookup per message)
+@filters.create
+async def not_known_command(_, __, message: Message) -> bool:
+    text = message.text
+    if not text:
+        return False
+    if not text.startswith("/"):
+        return True
+    return text.split(maxsplit=1)[0][1:].split("@")[0].lower() not in NON_QUERY_COMMANDS
+
+# Helper: Pagination buttons (cached per page number, buttons are never mutated after creation)
+@lru_cache(maxsize=256)
+def _prev_btn(page_num: int) -> InlineKeyboardButton:
+    return InlineKeyboardButton("⬅️ Previous", callback_data=f"page_{page_num}")
+
+@lru_cache(maxsize=256)
+def _next_btn(page_num: int) -> InlineKeyboardButton:
+    return InlineKeyboardButton("Next ➡️", callback_data=f"page_{page_num}")
+
+# Helper: Keyboard for every page of search results (dynamic IDs are generated here, once per search)
+def build_result_pages(results: List[dict]) -> List[InlineKeyboardMarkup]:
+    npages = -(-len(results) // PAGE_SIZE)
+    how_to_row = [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")]
+    markups = []
+    for page_num in range(1, npages + 1):
+        start = (page_num - 1) * PAGE_SIZE
+        buttons = []
+        for idx, file in enumerate(results[start:start + PAGE_SIZE], start=start + 1):
+            button_text = f"{idx}. 📁 {file['file_name']} ({file['file_size']}MB)"
+            buttons.append([InlineKeyboardButton(button_text, callback_data=file_callback("g", file["channel_id"], file["msg_id"]))])
+        buttons.append(how_to_row)
+        nav_buttons = []
+        if page_num > 1:
+            nav_buttons.append(_prev_btn(page_num - 1))
+        if page_num < npages:
+            nav_buttons.append(_next_btn(page_num + 1))
+        if nav_buttons:
+            buttons.append(nav_buttons)
+        markups.append(InlineKeyboardMarkup(buttons))
+    return markups
+
+# Helper: "DB or subscription channel?" keyboard for a forwarded channel
+def _channel_kind_kb(cid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(_DB_LABEL, callback_data=f"add_db_forward_{cid}")],
+        [InlineKeyboardButton(_SUB_LABEL, callback_data=f"add_sub_forward_{cid}")]
+    ])
+
+# Helper: Re-sort users by search count into the snapshot /user_stats pages are sliced from
+def refresh_user_stats_snapshot():
+    _user_stats_snapshot[:] = sorted(user_search_counts.items(), key=itemgetter(1), reverse=True)
+
+# Helper: Render one page of user activity statistics with navigation buttons
+def render_user_stats(rows: List[Tuple[int, int]], page_num: int, total_users: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    lines = ["📊 User Activity Statistics", "━" * 14]
+    lines.extend(f"User ID: {uid}, Searches: {count}" for uid, count in rows)
+    lines.append("━" * 14)
+    npages = max(1, -(-total_users // USER_STATS_PAGE_SIZE))
+    nav_buttons = []
+    if page_num > 1:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"ustats_{page_num - 1}"))
+    if page_num < npages:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"ustats_{page_num + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
 
 # Helper: Format caption using the custom caption format
 def format_caption(file_name: str, file_size: float) -> str:
@@ -213,6 +756,13 @@ def format_caption(file_name: str, file_size: float) -> str:
     caption = caption.replace("{size}", str(file_size))
     return caption
 
+# Invalidate cached privileges when the bot's own membership changes
+@app.on_chat_member_updated()
+async def handle_chat_member_updated(client: Client, update: ChatMemberUpdated):
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user and member.user.is_self:
+        invalidate_privileges(update.chat.id)
+
 # Feedback command handler
 @app.on_message(filters.command("feedback"))
 async def feedback_command(client: Client, message: Message):
@@ -268,6 +818,7 @@ async def channels_command(client: Client, message: Message):
         channels_text += "No subscription channels added.\n"
 
     channels_text += "\n🔹 **Log Channel** 📝\n"
+    log_channel = _state["log_channel"]
     if log_channel:
         channels_text += f"• {log_channel}\n"
     else:
@@ -308,48 +859,21 @@ async def start(client: Client, message: Message):
 
     # Check subscription (only in private chats)
     if chat_id > 0 and force_sub_channels and not await check_subscription(client, user_id, chat_id):
-        buttons = [[InlineKeyboardButton("Join Channel", url=f"https://t.me/c/{str(ch)[4:]}")] for ch in force_sub_channels]
-        buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="check_sub")])
-        await queue_message(message.reply, "Please join the required channels to use this bot: 📢", reply_markup=InlineKeyboardMarkup(buttons))
+        await queue_message(message.reply, "Please join the required channels to use this bot: 📢", reply_markup=subscription_keyboard())
         return
 
     # Welcome message for new users (only in private chats)
     if chat_id > 0:
-        buttons = [
-            [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
-            [InlineKeyboardButton("🕒 Recent Searches", callback_data="view_history")]
-        ]
-        await queue_message(client.send_message, user_id, "Welcome! 🎉\nSearch for files by typing a keyword, or use /help for guidance. 🔍", reply_markup=InlineKeyboardMarkup(buttons))
+        await queue_message(client.send_message, user_id, "Welcome! 🎉\nSearch for files by typing a keyword, or use /help for guidance. 🔍", reply_markup=WELCOME_BUTTONS)
 
     # Admin menu (text-based with "three lines" style, only in private chats)
     if chat_id > 0 and user_id in admin_list:
-        admin_menu = (
-            "👨‍💼 Admin Menu 🌟\n"
-            "━━━━━━━━━━━━━━\n"
-            "Available Commands:\n"
-            "/add_db - Add a DB channel 📚\n"
-            "/add_sub - Add a subscription channel 📢\n"
-            "/genbatch - Generate a new batch of files 🎁\n"
-            "/editbatch - Edit an existing batch of files ✏️\n"
-            "/caption - Set custom caption format for files 📜\n"
-            "/channels - List all configured channels 📋\n"
-            "/stats - View bot statistics 📊\n"
-            "/user_stats - View user activity statistics 📈\n"
-            "/broadcast - Broadcast a message 📣\n"
-            "/remove_channel - Remove a channel 🗑️\n"
-            "/admin_list - View admin list 👥\n"
-            "/set_logchannel - Set a log channel 📝\n"
-            "/set_rate_limit - Adjust rate limiting settings ⚙️\n"
-            "/clear_logs - Clear logs in log channel 🧹\n"
-            "━━━━━━━━━━━━━━\n"
-            "Enter the command to proceed (password required). 🔒"
-        )
-        await queue_message(message.reply, admin_menu)
+        await queue_message(message.reply, ADMIN_MENU_TEXT)
     else:
         await queue_message(message.reply, "Hi! 👋\nSend me a keyword to search for files, or use /help for guidance. 🔍")
 
 # Handle admin commands
-@app.on_message(filters.private & filters.command(["add_db", "add_sub", "genbatch", "editbatch", "caption", "channels", "stats", "user_stats", "broadcast", "remove_channel", "admin_list", "set_logchannel", "set_rate_limit", "clear_logs"]))
+@app.on_message(filters.private & filters.command(list(ADMIN_COMMANDS)))
 async def handle_admin_commands(client: Client, message: Message):
     user_id = message.from_user.id
     if user_id not in admin_list:
@@ -371,11 +895,6 @@ async def handle_admin_commands(client: Client, message: Message):
         await queue_message(message.reply, "Forward a message from the channel you want to set as the log channel (bot must be admin). 📝")
         return
 
-    if command == "set_rate_limit":
-        admin_pending_action[user_id] = "set_rate_limit"
-        await queue_message(message.reply, "Please provide the new rate limit settings in the format: max_messages min_delay (e.g., 15 1.5) ⚙️")
-        return
-
     if command == "genbatch":
         admin_pending_action[user_id] = "genbatch_keyword"
         await queue_message(message.reply, "🌟 Let's create a new batch! 🎁\nPlease provide the keyword for this batch (e.g., 'leo'):")
@@ -391,11 +910,10 @@ async def handle_admin_commands(client: Client, message: Message):
         return
 
     if command == "user_stats":
-        stats_text = "📊 User Activity Statistics\n━━━━━━━━━━━━━━\n"
-        for uid, count in user_search_counts.items():
-            stats_text += f"User ID: {uid}, Searches: {count}\n"
-        stats_text += "━━━━━━━━━━━━━━"
-        await queue_message(message.reply, stats_text)
+        # Sort once per /user_stats; every page (this one included) is a slice of the same snapshot
+        refresh_user_stats_snapshot()
+        stats_text, markup = render_user_stats(_user_stats_snapshot[:USER_STATS_PAGE_SIZE], 1, len(_user_stats_snapshot))
+        await queue_message(message.reply, stats_text, reply_markup=markup)
         await log_to_channel(client, f"Admin {user_id} successfully viewed user activity statistics")
         return
 
@@ -414,25 +932,162 @@ async def handle_admin_commands(client: Client, message: Message):
         return
 
     if command == "clear_logs":
+        log_channel = _state["log_channel"]
         if log_channel is None:
             await queue_message(message.reply, "❌ Failed to clear logs: No log channel set. Use /set_logchannel to set one. 📝")
             await log_to_channel(client, f"Admin {user_id} failed to clear logs: No log channel set")
             return
+        # Take the tracked IDs up front so log messages sent while deleting stay tracked
+        ids = [_log_msg_ids.popleft() for _ in range(len(_log_msg_ids))]
+        tracked = bool(ids)
+        deleted = 0
         try:
-            async for msg in client.get_chat_history(log_channel, limit=100):
-                await client.delete_messages(log_channel, msg.id)
+            if not tracked:  # Nothing tracked (e.g. after a restart), fall back to recent history
+                ids = [msg.id async for msg in client.get_chat_history(log_channel, limit=100)]
+            for i in range(0, len(ids), DELETE_MESSAGES_CHUNK):
+                await client.delete_messages(log_channel, ids[i:i + DELETE_MESSAGES_CHUNK])
+                deleted = i + DELETE_MESSAGES_CHUNK
             await queue_message(message.reply, "✅ Logs cleared successfully in the log channel! 🧹")
             await log_to_channel(client, f"Admin {user_id} successfully cleared logs in log channel {log_channel}")
         except Exception as e:
+            if tracked:  # Keep tracking the IDs that weren't deleted
+                _log_msg_ids.extendleft(reversed(ids[deleted:]))
             await queue_message(message.reply, f"❌ Failed to clear logs: An error occurred - {str(e)}. 😓")
             await log_to_channel(client, f"Admin {user_id} failed to clear logs in log channel {log_channel}: {str(e)}")
         return
 
     admin_pending_action[user_id] = command
-    await queue_message(message.reply, "🔒 Please enter the admin password to proceed:")
+    await queue_message(message.reply, PASSWORD_PROMPT)
+
+# Admin action: ask for a forwarded message from the DB channel to add
+async def _admin_add_db(client: Client, message: Message, action: str):
+    await queue_message(message.reply, "Forward a message from the DB channel you want to add (bot must be admin). 📚")
+
+# Admin action: ask for a forwarded message from the subscription channel to add
+async def _admin_add_sub(client: Client, message: Message, action: str):
+    await queue_message(message.reply, "Forward a message from the subscription channel you want to add (bot must be admin). 📢")
+
+# Admin action: show bot statistics
+async def _admin_stats(client: Client, message: Message, action: str):
+    user_id = message.from_user.id
+    stats = (
+        f"📊 Bot Statistics\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"Users: {len(verified_users)}\n"
+        f"DB Channels: {len(db_channels)}\n"
+        f"Sub Channels: {len(force_sub_channels)}\n"
+        f"Batches: {len(batches)}\n"
+        f"━━━━━━━━━━━━━━"
+    )
+    await queue_message(message.reply, stats)
+    await log_to_channel(client, f"Admin {user_id} successfully viewed bot statistics")
+
+# Admin action: offer the configured channels for removal
+async def _admin_remove_channel_menu(client: Client, message: Message, action: str):
+    user_id = message.from_user.id
+    if not db_channels and not force_sub_channels:
+        await queue_message(message.reply, "❌ Failed to remove channel: No channels available to remove. 📚📢")
+        await log_to_channel(client, f"Admin {user_id} failed to remove channel: No channels available")
+        return
+    buttons = [
+        [InlineKeyboardButton(f"DB: {ch}", callback_data=f"rm_db_{ch}") for ch in db_channels],
+        [InlineKeyboardButton(f"Sub: {ch}", callback_data=f"rm_sub_{ch}") for ch in force_sub_channels]
+    ]
+    await queue_message(message.reply, "Select channel to remove: 🗑️", reply_markup=InlineKeyboardMarkup(buttons))
+
+# Admin action: ask for the broadcast message
+async def _admin_broadcast(client: Client, message: Message, action: str):
+    admin_pending_action[message.from_user.id] = "broadcast_message"  # The next text goes to handle_broadcast_message
+    await queue_message(message.reply, "Please send the message you want to broadcast to all groups. 📣")
+
+# Admin action: ask for the new rate limit settings (applied by handle_query via _apply_rate_limit)
+async def _admin_set_rate_limit(client: Client, message: Message, action: str):
+    admin_pending_action[message.from_user.id] = "set_rate_limit_values"
+    await queue_message(message.reply, f"Please provide the new rate limit settings in the format: max_messages min_delay [silent_broadcast] (e.g., 15 1.5 1, or 15 1.5 off to broadcast with notifications). Current: {RATE_LIMIT_MAX_MESSAGES} {MIN_MESSAGE_DELAY} {'on' if BROADCAST_SILENT else 'off'} ⚙️")
+
+# Helper: Apply rate limit settings typed by an admin after /set_rate_limit
+async def _apply_rate_limit(client: Client, message: Message):
+    global RATE_LIMIT_MAX_MESSAGES, MIN_MESSAGE_DELAY, BROADCAST_SILENT, message_timestamps
+    user_id = message.from_user.id
+    try:
+        values = message.text.strip().lower().split()
+        if len(values) not in (2, 3):
+            raise ValueError("expected 2 or 3 values")
+        max_msgs, min_delay = map(float, values[:2])
+        if len(values) == 3 and values[2] not in _SILENT_FLAGS:
+            raise ValueError("invalid silent_broadcast flag")
+        silent = _SILENT_FLAGS[values[2]] if len(values) == 3 else BROADCAST_SILENT
+        # Non-finite or huge values would stall every send (inf delay) or overflow int()/deque
+        if not (math.isfinite(max_msgs) and math.isfinite(min_delay)) or not (1 <= max_msgs <= MAX_RATE_LIMIT_MESSAGES and 0.5 <= min_delay <= MAX_MESSAGE_DELAY):
+            await queue_message(message.reply, f"❌ Failed to set rate limit: max_messages must be between 1 and {MAX_RATE_LIMIT_MESSAGES}, min_delay must be between 0.5 and {MAX_MESSAGE_DELAY}. ⚙️")
+            await log_to_channel(client, f"Admin {user_id} failed to set rate limit: Invalid values (max_msgs={max_msgs}, min_delay={min_delay})")
+            return
+        RATE_LIMIT_MAX_MESSAGES = int(max_msgs)
+        MIN_MESSAGE_DELAY = min_delay
+        BROADCAST_SILENT = silent
+        # deque.maxlen is read-only, rebuild the window with the new size
+        message_timestamps = deque(message_timestamps, maxlen=RATE_LIMIT_MAX_MESSAGES)
+        await queue_message(message.reply, f"✅ Rate limits updated successfully: max_messages={RATE_LIMIT_MAX_MESSAGES}, min_delay={MIN_MESSAGE_DELAY}, silent_broadcast={BROADCAST_SILENT}! ⚙️")
+        await log_to_channel(client, f"Admin {user_id} successfully updated rate limits: max_messages={RATE_LIMIT_MAX_MESSAGES}, min_delay={MIN_MESSAGE_DELAY}, silent_broadcast={BROADCAST_SILENT}")
+    except ValueError:
+        await queue_message(message.reply, "❌ Failed to set rate limit: Invalid format. Please use: max_messages min_delay [silent_broadcast] (e.g., 15 1.5 1). ⚙️")
+        await log_to_channel(client, f"Admin {user_id} failed to set rate limit: Invalid format")
+
+# Admin action: add a forwarded channel as DB or subscription channel (add_<db|sub>_forward_<channel_id>)
+async def _admin_add_forwarded_channel(client: Client, message: Message, action: str):
+    user_id = message.from_user.id
+    channel_type, _, channel_id = action.split("_")[1:4]
+    channel_id = int(channel_id)
+    if not await check_bot_privileges(client, channel_id):
+        await queue_message(message.reply, f"❌ Failed to add {channel_type} channel: Bot must be an admin in the channel {channel_id} with sufficient privileges. ⚙️")
+        await log_to_channel(client, f"Admin {user_id} failed to add {channel_type} channel {channel_id}: Bot lacks admin privileges")
+        return
+
+    if channel_type == "db":
+        db_channels.add(channel_id)
+        invalidate_channels_cache()
+        await queue_message(message.reply, f"✅ DB channel {channel_id} added successfully! 📚")
+        await log_to_channel(client, f"Admin {user_id} successfully added DB channel {channel_id}")
+    else:  # sub
+        force_sub_channels.add(channel_id)
+        invalidate_channels_cache()
+        await queue_message(message.reply, f"✅ Subscription channel {channel_id} added successfully! 📢")
+        await log_to_channel(client, f"Admin {user_id} successfully added subscription channel {channel_id}")
+
+# Admin action: remove a DB or subscription channel (rm_<db|sub>_<channel_id>)
+async def _admin_remove_channel(client: Client, message: Message, action: str):
+    user_id = message.from_user.id
+    _, kind, channel_id = action.split("_", 2)
+    channel_id = int(channel_id)
+    if kind == "db":
+        channels, label, title, emoji = db_channels, "DB", "DB", "📚"
+    else:
+        channels, label, title, emoji = force_sub_channels, "subscription", "Subscription", "📢"
+    if channel_id not in channels:
+        await queue_message(message.reply, f"❌ Failed to remove {label} channel: Channel {channel_id} not found in {label} channels. {emoji}")
+        await log_to_channel(client, f"Admin {user_id} failed to remove {label} channel {channel_id}: Channel not found")
+        return
+    channels.discard(channel_id)
+    invalidate_channels_cache()
+    await queue_message(message.reply, f"✅ {title} channel {channel_id} removed successfully! 🗑️")
+    await log_to_channel(client, f"Admin {user_id} successfully removed {label} channel {channel_id}")
+
+# Password-protected admin actions, by exact action name and by action prefix
+_ADMIN_ACTIONS: Dict[str, Callable[[Client, Message, str], Awaitable[None]]] = {
+    "add_db": _admin_add_db,
+    "add_sub": _admin_add_sub,
+    "stats": _admin_stats,
+    "remove_channel": _admin_remove_channel_menu,
+    "broadcast": _admin_broadcast,
+    "set_rate_limit": _admin_set_rate_limit,
+}
+_PREFIX_ACTIONS: Dict[str, Callable[[Client, Message, str], Awaitable[None]]] = {
+    "add": _admin_add_forwarded_channel,  # add_db_forward_<id>, add_sub_forward_<id>
+    "rm": _admin_remove_channel,  # rm_db_<id>, rm_sub_<id>
+}
 
 # Handle text queries (works in both private and group chats)
-@app.on_message(filters.text & ~filters.command(["start", "help", "feedback", "add_db", "add_sub", "genbatch", "editbatch", "caption", "channels", "stats", "user_stats", "broadcast", "remove_channel", "admin_list", "set_logchannel", "set_rate_limit", "clear_logs"]))
+@app.on_message(filters.text & not_known_command)
 async def handle_query(client: Client, message: Message):
     user_id = message.from_user.id
     chat_id = message.chat.id
@@ -440,173 +1095,111 @@ async def handle_query(client: Client, message: Message):
 
     # Prevent duplicate processing of the same message
     if chat_id in message_pairs:
-        logger.warning(f"Duplicate query detected in chat {chat_id}, ignoring.")
+        logger.warning("Duplicate query detected in chat %s, ignoring.", chat_id)
         return
 
     # Log the search query, update history, and count
     await log_to_channel(client, f"User {user_id} searched for: '{query}' in chat {chat_id}")
-    user_search_history[user_id].append((query, time.time()))
-    user_search_counts[user_id] += 1
-
-    # Check if the message is a password response for admin (only in private chats)
-    if chat_id > 0 and user_id in admin_list and user_id in admin_pending_action:
+    history = user_search_history.get(user_id)
+    if history is None:
+        history = deque(maxlen=5)
+    history.append((query, time.time()))
+    user_search_history[user_id] = history  # Re-set to refresh the entry's TTL
+    user_search_counts[user_id] = user_search_counts.get(user_id, 0) + 1
+
+    # Pending admin action for this message (only in private chats)
+    pending = admin_pending_action.get(user_id) if chat_id > 0 and user_id in admin_list else None
+    # Rate limit values sent after the password was accepted
+    if pending == "set_rate_limit_values":
+        del admin_pending_action[user_id]
+        await _apply_rate_limit(client, message)
+        return
+    # Handle genbatch/editbatch input (these states are reached without a password)
+    if pending == "genbatch_keyword":
+        if not query:
+            await queue_message(message.reply, "❌ Failed to create batch: Please provide a valid keyword. 🖋️")
+            await log_to_channel(client, f"Admin {user_id} failed to create batch: Invalid keyword")
+            return
+        admin_batch_keywords[user_id] = query.lower()
+        admin_pending_action[user_id] = "genbatch_files"
+        # Generate a secret start_id for the batch
+        batch_start_id = generate_dynamic_id()
+        batch_start_ids[query.lower()] = batch_start_id
+        batches[query.lower()] = {"channel_id": None, "msg_ids": [], "files": [], "start_id": batch_start_id}
+        index_batch_keyword(query.lower())
+        await log_to_channel(client, f"Batch Start ID: {batch_start_id} for keyword: {query.lower()}")
+        await queue_message(
+            message.reply,
+            f"🎉 Batch '{query}' created! Let's add some files! 📁\n"
+            f"Send the files you want to include in this batch. When you're done, use the 'Done' button or type 'Done'. 🚀\n"
+            f"You can also add a fun sticker to make it more exciting! 🎈",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📤 Add Files", callback_data="genbatch_add_files")],
+                [InlineKeyboardButton("🎉 Sticker Panel", callback_data="genbatch_sticker_panel")],
+                [InlineKeyboardButton("✅ Done", callback_data="genbatch_done")],
+                [InlineKeyboardButton("❌ Cancel Batch", callback_data="genbatch_cancel")]
+            ])
+        )
+        return
+    if pending == "editbatch_keyword":
+        if not query:
+            await queue_message(message.reply, "❌ Failed to edit batch: Please provide a valid keyword. 🖋️")
+            await log_to_channel(client, f"Admin {user_id} failed to edit batch: Invalid keyword")
+            return
+        keyword = query.lower()
+        if keyword not in batches:
+            await queue_message(message.reply, f"❌ Failed to edit batch: No batch found with keyword '{keyword}'. Create a batch using /genbatch first. 🎁")
+            await log_to_channel(client, f"Admin {user_id} failed to edit batch: No batch found with keyword '{keyword}'")
+            admin_pending_action.pop(user_id, None)
+            return
+        admin_batch_keywords[user_id] = keyword
+        admin_pending_action[user_id] = "editbatch_files"
+        _batch_edits_cleared.discard(user_id)
+        await queue_message(
+            message.reply,
+            f"✏️ Editing batch '{keyword}'! 📝\n"
+            f"Send the new files for this batch. When you're done, use the 'Done' button or type 'Done'. 🚀\n"
+            f"Add a sticker to make it more fun! 🎈",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📤 Add Files", callback_data="editbatch_add_files")],
+                [InlineKeyboardButton("🎉 Sticker Panel", callback_data="editbatch_sticker_panel")],
+                [InlineKeyboardButton("✅ Done", callback_data="editbatch_done")],
+                [InlineKeyboardButton("❌ Cancel Batch", callback_data="editbatch_cancel")]
+            ])
+        )
+        return
+    if pending in ("genbatch_files", "editbatch_files"):
+        if query != "done":
+            await queue_message(message.reply, "📁 Send a file to add it to the batch, or type 'Done' when you're finished. 🚀")
+            return
+        keyword = admin_batch_keywords[user_id]
+        num_files = len(batches[keyword]["msg_ids"]) if keyword in batches else 0
+        if pending == "genbatch_files":
+            await queue_message(message.reply, f"✅ Batch '{keyword}' created successfully with {num_files} files! 🎉")
+            await log_to_channel(client, f"Admin {user_id} successfully completed batch creation for keyword '{keyword}' with {num_files} files")
+        else:
+            await queue_message(message.reply, f"✅ Batch '{keyword}' updated successfully with {num_files} files! ✏️")
+            await log_to_channel(client, f"Admin {user_id} successfully completed batch edit for keyword '{keyword}' with {num_files} files")
+        admin_pending_action.pop(user_id, None)
+        admin_batch_keywords.pop(user_id, None)
+        save_batches()
+        return
+    # Check if the message is a password response for admin
+    if pending is not None:
         if query == ADMIN_PASSWORD:
-            action = admin_pending_action.pop(user_id)
-            if action == "add_db":
-                await queue_message(message.reply, "Forward a message from the DB channel you want to add (bot must be admin). 📚")
-            elif action == "add_sub":
-                await queue_message(message.reply, "Forward a message from the subscription channel you want to add (bot must be admin). 📢")
-            elif action == "stats":
-                stats = (
-                    f"📊 Bot Statistics\n"
-                    f"━━━━━━━━━━━━━━\n"
-                    f"Users: {len(verified_users)}\n"
-                    f"DB Channels: {len(db_channels)}\n"
-                    f"Sub Channels: {len(force_sub_channels)}\n"
-                    f"Batches: {len(batches)}\n"
-                    f"━━━━━━━━━━━━━━"
-                )
-                await queue_message(message.reply, stats)
-                await log_to_channel(client, f"Admin {user_id} successfully viewed bot statistics")
-            elif action == "remove_channel":
-                if not db_channels and not force_sub_channels:
-                    await queue_message(message.reply, "❌ Failed to remove channel: No channels available to remove. 📚📢")
-                    await log_to_channel(client, f"Admin {user_id} failed to remove channel: No channels available")
-                    return
-                buttons = [
-                    [InlineKeyboardButton(f"DB: {ch}", callback_data=f"rm_db_{ch}") for ch in db_channels],
-                    [InlineKeyboardButton(f"Sub: {ch}", callback_data=f"rm_sub_{ch}") for ch in force_sub_channels]
-                ]
-                await queue_message(message.reply, "Select channel to remove: 🗑️", reply_markup=InlineKeyboardMarkup(buttons))
-            elif action == "broadcast":
-                await queue_message(message.reply, "Please send the message you want to broadcast to all groups. 📣")
-            elif action == "set_rate_limit":
-                try:
-                    max_msgs, min_delay = map(float, query.split())
-                    if max_msgs < 1 or min_delay < 0.5:
-                        await queue_message(message.reply, "❌ Failed to set rate limit: max_messages must be >= 1, min_delay must be >= 0.5. ⚙️")
-                        await log_to_channel(client, f"Admin {user_id} failed to set rate limit: Invalid values (max_msgs={max_msgs}, min_delay={min_delay})")
-                        return
-                    global RATE_LIMIT_MAX_MESSAGES, MIN_MESSAGE_DELAY
-                    RATE_LIMIT_MAX_MESSAGES = int(max_msgs)
-                    MIN_MESSAGE_DELAY = min_delay
-                    message_timestamps.maxlen = RATE_LIMIT_MAX_MESSAGES
-                    await queue_message(message.reply, f"✅ Rate limits updated successfully: max_messages={RATE_LIMIT_MAX_MESSAGES}, min_delay={MIN_MESSAGE_DELAY}! ⚙️")
-                    await log_to_channel(client, f"Admin {user_id} successfully updated rate limits: max_messages={RATE_LIMIT_MAX_MESSAGES}, min_delay={MIN_MESSAGE_DELAY}")
-                except ValueError:
-                    await queue_message(message.reply, "❌ Failed to set rate limit: Invalid format. Please use: max_messages min_delay (e.g., 15 1.5). ⚙️")
-                    await log_to_channel(client, f"Admin {user_id} failed to set rate limit: Invalid format")
-            elif action.startswith("add_db_forward_") or action.startswith("add_sub_forward_"):
-                channel_type, _, channel_id = action.split("_")[1:4]
-                channel_id = int(channel_id)
-                if not await check_bot_privileges(client, channel_id):
-                    await queue_message(message.reply, f"❌ Failed to add {channel_type} channel: Bot must be an admin in the channel {channel_id} with sufficient privileges. ⚙️")
-                    await log_to_channel(client, f"Admin {user_id} failed to add {channel_type} channel {channel_id}: Bot lacks admin privileges")
-                    return
-
-                if channel_type == "db":
-                    db_channels.add(channel_id)
-                    await queue_message(message.reply, f"✅ DB channel {channel_id} added successfully! 📚")
-                    await log_to_channel(client, f"Admin {user_id} successfully added DB channel {channel_id}")
-                else:  # sub
-                    force_sub_channels.add(channel_id)
-                    await queue_message(message.reply, f"✅ Subscription channel {channel_id} added successfully! 📢")
-                    await log_to_channel(client, f"Admin {user_id} successfully added subscription channel {channel_id}")
-            elif action.startswith("rm_db_"):
-                channel_id = int(action.split("_")[2])
-                if channel_id not in db_channels:
-                    await queue_message(message.reply, f"❌ Failed to remove DB channel: Channel {channel_id} not found in DB channels. 📚")
-                    await log_to_channel(client, f"Admin {user_id} failed to remove DB channel {channel_id}: Channel not found")
-                    return
-                db_channels.discard(channel_id)
-                await queue_message(message.reply, f"✅ DB channel {channel_id} removed successfully! 🗑️")
-                await log_to_channel(client, f"Admin {user_id} successfully removed DB channel {channel_id}")
-            elif action.startswith("rm_sub_"):
-                channel_id = int(action.split("_")[2])
-                if channel_id not in force_sub_channels:
-                    await queue_message(message.reply, f"❌ Failed to remove subscription channel: Channel {channel_id} not found in subscription channels. 📢")
-                    await log_to_channel(client, f"Admin {user_id} failed to remove subscription channel {channel_id}: Channel not found")
-                    return
-                force_sub_channels.discard(channel_id)
-                await queue_message(message.reply, f"✅ Subscription channel {channel_id} removed successfully! 🗑️")
-                await log_to_channel(client, f"Admin {user_id} successfully removed subscription channel {channel_id}")
+            del admin_pending_action[user_id]
+            handler = _ADMIN_ACTIONS.get(pending) or _PREFIX_ACTIONS.get(pending.split("_", 1)[0])
+            if handler is not None:
+                await handler(client, message, pending)
         else:
             await queue_message(message.reply, "❌ Failed to authenticate: Incorrect password. Try again. 🔒")
             await log_to_channel(client, f"Admin {user_id} failed to authenticate: Incorrect password")
             admin_pending_action.pop(user_id, None)
         return
 
-    # Handle genbatch/editbatch keyword input
-    if chat_id > 0 and user_id in admin_list and user_id in admin_pending_action:
-        if admin_pending_action[user_id] == "genbatch_keyword":
-            if not query:
-                await queue_message(message.reply, "❌ Failed to create batch: Please provide a valid keyword. 🖋️")
-                await log_to_channel(client, f"Admin {user_id} failed to create batch: Invalid keyword")
-                return
-            admin_batch_keywords[user_id] = query.lower()
-            admin_pending_action[user_id] = "genbatch_files"
-            # Generate a secret start_id for the batch
-            batch_start_id = generate_dynamic_id()
-            batch_start_ids[query.lower()] = batch_start_id
-            batches[query.lower()] = {"channel_id": None, "msg_ids": [], "start_id": batch_start_id}
-            await log_to_channel(client, f"Batch Start ID: {batch_start_id} for keyword: {query.lower()}")
-            await queue_message(
-                message.reply,
-                f"🎉 Batch '{query}' created! Let's add some files! 📁\n"
-                f"Send the files you want to include in this batch. When you're done, use the 'Done' button or type 'Done'. 🚀\n"
-                f"You can also add a fun sticker to make it more exciting! 🎈",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📤 Add Files", callback_data="genbatch_add_files")],
-                    [InlineKeyboardButton("🎉 Sticker Panel", callback_data="genbatch_sticker_panel")],
-                    [InlineKeyboardButton("✅ Done", callback_data="genbatch_done")],
-                    [InlineKeyboardButton("❌ Cancel Batch", callback_data="genbatch_cancel")]
-                ])
-            )
-            return
-        elif admin_pending_action[user_id] == "editbatch_keyword":
-            if not query:
-                await queue_message(message.reply, "❌ Failed to edit batch: Please provide a valid keyword. 🖋️")
-                await log_to_channel(client, f"Admin {user_id} failed to edit batch: Invalid keyword")
-                return
-            keyword = query.lower()
-            if keyword not in batches:
-                await queue_message(message.reply, f"❌ Failed to edit batch: No batch found with keyword '{keyword}'. Create a batch using /genbatch first. 🎁")
-                await log_to_channel(client, f"Admin {user_id} failed to edit batch: No batch found with keyword '{keyword}'")
-                admin_pending_action.pop(user_id, None)
-                return
-            admin_batch_keywords[user_id] = keyword
-            admin_pending_action[user_id] = "editbatch_files"
-            await queue_message(
-                message.reply,
-                f"✏️ Editing batch '{keyword}'! 📝\n"
-                f"Send the new files for this batch. When you're done, use the 'Done' button or type 'Done'. 🚀\n"
-                f"Add a sticker to make it more fun! 🎈",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📤 Add Files", callback_data="editbatch_add_files")],
-                    [InlineKeyboardButton("🎉 Sticker Panel", callback_data="editbatch_sticker_panel")],
-                    [InlineKeyboardButton("✅ Done", callback_data="editbatch_done")],
-                    [InlineKeyboardButton("❌ Cancel Batch", callback_data="editbatch_cancel")]
-                ])
-            )
-            return
-        elif admin_pending_action[user_id] in ("genbatch_files", "editbatch_files") and query.lower() == "done":
-            keyword = admin_batch_keywords[user_id]
-            num_files = len(batches[keyword]["msg_ids"]) if keyword in batches else 0
-            if admin_pending_action[user_id] == "genbatch_files":
-                await queue_message(message.reply, f"✅ Batch '{keyword}' created successfully with {num_files} files! 🎉")
-                await log_to_channel(client, f"Admin {user_id} successfully completed batch creation for keyword '{keyword}' with {num_files} files")
-            else:
-                await queue_message(message.reply, f"✅ Batch '{keyword}' updated successfully with {num_files} files! ✏️")
-                await log_to_channel(client, f"Admin {user_id} successfully completed batch edit for keyword '{keyword}' with {num_files} files")
-            admin_pending_action.pop(user_id, None)
-            admin_batch_keywords.pop(user_id, None)
-            return
-
     # Check subscription (only in private chats)
     if chat_id > 0 and force_sub_channels and not await check_subscription(client, user_id, chat_id):
-        buttons = [[InlineKeyboardButton("Join Channel", url=f"https://t.me/c/{str(ch)[4:]}")] for ch in force_sub_channels]
-        buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="check_sub")])
-        await queue_message(message.reply, "Please join the required channels to use this bot: 📢", reply_markup=InlineKeyboardMarkup(buttons))
+        await queue_message(message.reply, "Please join the required channels to use this bot: 📢", reply_markup=subscription_keyboard())
         return
 
     # Input validation
@@ -623,69 +1216,43 @@ async def handle_query(client: Client, message: Message):
             return
 
     searching_msg = await message.reply("🔍 Searching for your query... 🌟")
-    message_pairs[chat_id] = (message.id, searching_msg.id)
-
-    # Check if query matches a batch
-    batch_results = []
-    matched_keyword = None
-    for keyword in batches:
-        if query in keyword or keyword in query:  # Partial match
-            matched_keyword = keyword
-            batch = batches[keyword]
-            channel_id = batch["channel_id"]
-            msg_ids = batch["msg_ids"]
-            try:
-                for msg_id in msg_ids:
-                    msg = await client.get_messages(channel_id, msg_id)
-                    if msg.media in (MessageMediaType.DOCUMENT, MessageMediaType.PHOTO, MessageMediaType.VIDEO, MessageMediaType.AUDIO) and hasattr(msg, 'document') and msg.document:
-                        file_name = msg.document.file_name or "Unnamed File"
-                        batch_results.append({
-                            "file_name": file_name,
-                            "file_size": round(msg.document.file_size / (1024 * 1024), 2),
-                            "file_id": msg.document.file_id,
-                            "msg_id": msg.id,
-                            "channel_id": channel_id
-                        })
-            except Exception as e:
-                await log_to_channel(client, f"Error fetching batch files for keyword '{keyword}': {str(e)}")
-                await queue_message(searching_msg.edit, f"❌ Failed to fetch batch files: An error occurred - {str(e)}. 😓")
-                message_pairs.pop(chat_id, None)
-                return
-            break
+    track_message_pair(chat_id, message.id, searching_msg.id)
+
+    # Check if query matches a batch (file metadata was stored when the batch was built)
+    matched_keyword = find_batch_keyword(query)  # Partial match via the trigram index
+    batch_results = batches[matched_keyword]["files"] if matched_keyword is not None else []
 
     if batch_results:
         await log_to_channel(client, f"User {user_id} successfully found batch match for query '{query}' with keyword '{matched_keyword}'")
         # Format the results as specified
-        result_text = f"available:\n"
+        result_parts = ["available:\n"]
         buttons = []
         for idx, file in enumerate(batch_results, 1):
             file_name = file["file_name"]
             file_size = file["file_size"]
             channel_id = file["channel_id"]
             msg_id = file["msg_id"]
-            channel_id_str = str(channel_id)[4:] if str(channel_id).startswith("-100") else str(channel_id)
-            file_link = f"https://t.me/c/{channel_id_str}/{msg_id}"
+            file_link = message_link(channel_id, msg_id)
             shortened_link = await shorten_link(file_link)
-            result_text += f"📁 {file_name} ({file_size}MB)\n🔗 Applied link shortener: {shortened_link}\n\n"
-            dyn_id = generate_dynamic_id()
+            result_parts.append(f"📁 {file_name} ({file_size}MB)\n🔗 Applied link shortener: {shortened_link}\n\n")
             buttons.append([
                 InlineKeyboardButton("⬇️ Download", url=shortened_link),
                 InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7"),
-                InlineKeyboardButton("🔗 Share File", callback_data=f"share_{channel_id}_{msg_id}_{dyn_id}")
+                InlineKeyboardButton("🔗 Share File", callback_data=file_callback("s", channel_id, msg_id))
             ])
+        result_text = "".join(result_parts)
         await queue_message(
             searching_msg.edit,
             f"✅ Found {len(batch_results)} file(s) in batch '{matched_keyword}'! 🎉\n\n{result_text}",
             reply_markup=InlineKeyboardMarkup(buttons)
         )
-        message_pairs[chat_id] = (message.id, searching_msg.id)
-        asyncio.create_task(delete_messages_later(client, chat_id, message.id, searching_msg.id))
+        track_message_pair(chat_id, message.id, searching_msg.id)
+        schedule_message_deletion(client, chat_id, message.id, searching_msg.id)
         return
 
     # Check if results are in cache
-    now = time.time()
-    if chat_id in search_cache and chat_id in search_cache_expiry and now < search_cache_expiry[chat_id]:
-        results = search_cache[chat_id]
+    results = search_cache.get(chat_id)
+    if results is not None:
         await log_to_channel(client, f"User {user_id} successfully used cached results for query: '{query}'")
     else:
         # Search channels concurrently
@@ -693,47 +1260,63 @@ async def handle_query(client: Client, message: Message):
         async def search_channel(channel_id: int):
             try:
                 if not await check_bot_privileges(client, channel_id, require_admin=False):
-                    logger.warning(f"Bot lacks access to channel {channel_id}")
+                    logger.warning("Bot lacks access to channel %s", channel_id)
+                    return
+
+                results_left = SEARCH_LIMIT - len(results)
+                if results_left <= 0:
                     return
 
-                # Search for messages matching the query
-                async for msg in client.search_messages(chat_id=channel_id, query=query, limit=SEARCH_LIMIT):
-                    # Check if the message is a document or has a caption matching the query
-                    if msg.media == MessageMediaType.DOCUMENT and hasattr(msg, 'document') and msg.document:
-                        file_name = msg.document.file_name or "Unnamed File"
-                        # Also check caption for broader matching
-                        caption = msg.caption.lower() if msg.caption else ""
-                        if query in file_name.lower() or query in caption:
-                            results.append({
-                                "file_name": file_name,
-                                "file_size": round(msg.document.file_size / (1024 * 1024), 2),
-                                "file_id": msg.document.file_id,
-                                "msg_id": msg.id,
-                                "channel_id": channel_id
-                            })
-                            logger.info(f"Match found in channel {channel_id}: {file_name}")
-                    else:
+                debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                # Search for messages matching the query (Telegram already filters on the query server-side)
+                async for msg in client.search_messages(chat_id=channel_id, query=query, limit=results_left):
+                    if len(results) >= SEARCH_LIMIT:
+                        break
+                    doc = msg.document
+                    if msg.media == MessageMediaType.DOCUMENT and doc is not None:
+                        entry = file_entry(doc, msg.id, channel_id)
+                        results.append(entry)
+                        logger.info("Match found in channel %s: %s", channel_id, entry["file_name"])
+                    elif debug_enabled:
                         # Log if a message doesn't match the criteria
-                        logger.debug(f"Message {msg.id} in channel {channel_id} is not a document or doesn't match query")
+                        logger.debug("Message %s in channel %s is not a document", msg.id, channel_id)
             except errors.ChannelPrivate:
-                logger.error(f"Channel {channel_id} is private or bot lacks access")
+                logger.error("Channel %s is private or bot lacks access", channel_id)
                 db_channels.discard(channel_id)
+                invalidate_channels_cache()
             except Exception as e:
                 await log_to_channel(client, f"Search error in channel {channel_id}: {str(e)}")
-                logger.error(f"Search error in channel {channel_id}: {e}")
+                logger.error("Search error in channel %s: %s", channel_id, e)
+
+        semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+        async def guarded_search(channel_id: int):
+            async with semaphore:
+                await search_channel(channel_id)
 
         try:
-            tasks = [search_channel(channel_id) for channel_id in db_channels]
-            await asyncio.gather(*tasks)
+            tasks = [asyncio.create_task(guarded_search(channel_id)) for channel_id in list(db_channels)]
+            try:
+                # Stop waiting on the remaining channels once enough results are in
+                for finished in asyncio.as_completed(tasks):
+                    try:
+                        await finished
+                    except Exception as e:
+                        logger.error("Search task failed: %s", e)
+                    if len(results) >= SEARCH_LIMIT:
+                        break
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
 
             if not results:
                 await queue_message(searching_msg.edit, "❌ No files found in the database channels. 😔")
                 await log_to_channel(client, f"User {user_id} failed to find matches for query '{query}' in chat {chat_id}")
                 return
 
-            # Cache the results
+            # Cache the results and their page keyboards
             search_cache[chat_id] = results
-            search_cache_expiry[chat_id] = now + CACHE_DURATION
+            search_pages_cache[chat_id] = build_result_pages(results)
             await log_to_channel(client, f"User {user_id} successfully searched and cached results for query: '{query}'")
         except Exception as e:
             await queue_message(searching_msg.edit, f"❌ Failed to search: An error occurred - {str(e)}. 😓")
@@ -741,39 +1324,26 @@ async def handle_query(client: Client, message: Message):
             message_pairs.pop(chat_id, None)
             return
 
-    # Display results (first page)
-    pages = [results[i:i + PAGE_SIZE] for i in range(0, len(results), PAGE_SIZE)]
-    page_num = 1
-    page = pages[page_num - 1]  # First page
-    buttons = []
-    for idx, file in enumerate(page, start=(page_num-1)*PAGE_SIZE + 1):
-        dyn_id = generate_dynamic_id()
-        button_text = f"{idx}. 📁 {file['file_name']} ({file['file_size']}MB)"
-        buttons.append([InlineKeyboardButton(button_text, callback_data=f"get_{file['channel_id']}_{file['msg_id']}_{dyn_id}")])
-    buttons.append([InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")])
-    if len(pages) > 1:
-        nav_buttons = []
-        if page_num < len(pages):
-            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"page_{page_num+1}"))
-        buttons.append(nav_buttons)
+    # Display results (first page); every page's keyboard is built once and reused by page_ callbacks
+    page_markups = search_pages_cache.get(chat_id)
+    if page_markups is None:
+        page_markups = search_pages_cache[chat_id] = build_result_pages(results)
 
     # Edit the searching message to show results
     await queue_message(
         searching_msg.edit,
-        f"✅ Found {len(results)} file(s) matching your query! 🎉\n\n📂 Search Results (Page {page_num}/{len(pages)}):",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        f"✅ Found {len(results)} file(s) matching your query! 🎉\n\n📂 Search Results (Page 1/{len(page_markups)}):",
+        reply_markup=page_markups[0]
     )
-    message_pairs[chat_id] = (message.id, searching_msg.id)
-    asyncio.create_task(delete_messages_later(client, chat_id, message.id, searching_msg.id))
+    track_message_pair(chat_id, message.id, searching_msg.id)
+    schedule_message_deletion(client, chat_id, message.id, searching_msg.id)
 
 # Handle media messages (for genbatch/editbatch)
 @app.on_message(filters.private & (filters.document | filters.photo | filters.video | filters.audio))
 async def handle_media(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id not in admin_list or user_id not in admin_pending_action:
-        return
-
-    if admin_pending_action[user_id] not in ("genbatch_files", "editbatch_files"):
+    pending = admin_pending_action.get(user_id) if user_id in admin_list else None
+    if pending not in ("genbatch_files", "editbatch_files"):
         return
 
     # Check if a database channel exists
@@ -789,8 +1359,8 @@ async def handle_media(client: Client, message: Message):
     keyword = admin_batch_keywords[user_id]
 
     try:
-        # If editing a batch, delete the old files
-        if admin_pending_action[user_id] == "editbatch_files":
+        # If editing a batch, delete the old files (once, on the first new upload)
+        if pending == "editbatch_files" and user_id not in _batch_edits_cleared:
             if keyword in batches:
                 old_batch = batches[keyword]
                 old_channel_id = old_batch["channel_id"]
@@ -800,8 +1370,11 @@ async def handle_media(client: Client, message: Message):
                     await log_to_channel(client, f"Admin {user_id} successfully deleted old files for batch '{keyword}' in channel {old_channel_id}")
                 except Exception as e:
                     await log_to_channel(client, f"Admin {user_id} failed to delete old files for batch '{keyword}': {str(e)}")
-                # Clear the old message IDs
+                # Clear the old message IDs and file metadata
                 batches[keyword]["msg_ids"] = []
+                batches[keyword]["files"] = []
+                _batch_edits_cleared.add(user_id)
+                save_batches()  # The old files are gone; don't let a restart bring back their IDs
             else:
                 await queue_message(message.reply, "❌ Failed to edit batch: Batch not found. Please start over with /editbatch. 😔")
                 await log_to_channel(client, f"Admin {user_id} failed to edit batch: Batch '{keyword}' not found")
@@ -831,18 +1404,23 @@ async def handle_media(client: Client, message: Message):
             await log_to_channel(client, f"Admin {user_id} failed to add file to batch '{keyword}': Unsupported file type")
             return
 
-        # Store the message ID in the batch
+        # Store the message ID in the batch, plus the metadata searches return for documents
         batches[keyword]["msg_ids"].append(sent_msg.id)
+        doc = sent_msg.document
+        if doc is not None:
+            batches[keyword]["files"].append(file_entry(doc, sent_msg.id, channel_id))
+        save_batches()  # Persist each upload so a restart mid-batch keeps the files already sent
         await log_to_channel(client, f"Admin {user_id} successfully added file to batch '{keyword}' in channel {channel_id}, msg_id: {sent_msg.id}")
 
+        flow = "genbatch" if pending == "genbatch_files" else "editbatch"
         await queue_message(
             message.reply,
             f"✅ File '{file_name}' added to batch '{keyword}' successfully! 🎉\nSend more files or use the buttons below to continue. 🚀",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📤 Add More Files", callback_data="genbatch_add_files" if admin_pending_action[user_id] == "genbatch_files" else "editbatch_add_files")],
-                [InlineKeyboardButton("🎉 Sticker Panel", callback_data="genbatch_sticker_panel" if admin_pending_action[user_id] == "genbatch_files" else "editbatch_sticker_panel")],
-                [InlineKeyboardButton("✅ Done", callback_data="genbatch_done" if admin_pending_action[user_id] == "genbatch_files" else "editbatch_done")],
-                [InlineKeyboardButton("❌ Cancel Batch", callback_data="genbatch_cancel" if admin_pending_action[user_id] == "genbatch_files" else "editbatch_cancel")]
+                [InlineKeyboardButton("📤 Add More Files", callback_data=f"{flow}_add_files")],
+                [InlineKeyboardButton("🎉 Sticker Panel", callback_data=f"{flow}_sticker_panel")],
+                [InlineKeyboardButton("✅ Done", callback_data=f"{flow}_done")],
+                [InlineKeyboardButton("❌ Cancel Batch", callback_data=f"{flow}_cancel")]
             ])
         )
 
@@ -852,306 +1430,384 @@ async def handle_media(client: Client, message: Message):
         admin_pending_action.pop(user_id, None)
         admin_batch_keywords.pop(user_id, None)
 
-# Callback query handler
-@app.on_callback_query()
-async def handle_callbacks(client: Client, callback_query):
-    data = callback_query.data
+# Callback: Verify the user's forced subscriptions
+async def _cb_check_sub(client: Client, callback_query: CallbackQuery, data: str):
     user_id = callback_query.from_user.id
     chat_id = callback_query.message.chat.id
+    if await check_subscription(client, user_id, chat_id):
+        verified_users[user_id] = time.time()
+        await queue_message(callback_query.message.edit, "✅ Subscription verified successfully! You can now search for files. 🎉")
+        await log_to_channel(client, f"User {user_id} successfully verified subscription in chat {chat_id}")
+    else:
+        await callback_query.answer("❌ Failed to verify subscription: Please join all required channels. 📢", show_alert=True)
+        await log_to_channel(client, f"User {user_id} failed to verify subscription in chat {chat_id}")
 
-    try:
-        if data == "check_sub":
-            if await check_subscription(client, user_id, chat_id):
-                verified_users[user_id] = time.time()
-                await queue_message(callback_query.message.edit, "✅ Subscription verified successfully! You can now search for files. 🎉")
-                await log_to_channel(client, f"User {user_id} successfully verified subscription in chat {chat_id}")
-            else:
-                await callback_query.answer("❌ Failed to verify subscription: Please join all required channels. 📢", show_alert=True)
-                await log_to_channel(client, f"User {user_id} failed to verify subscription in chat {chat_id}")
-
-        elif data == "view_history":
-            history = user_search_history.get(user_id, [])
-            if not history:
-                await queue_message(callback_query.message.reply, "❌ Failed to view history: You have no recent searches. 🕒")
-                await log_to_channel(client, f"User {user_id} failed to view search history: No recent searches")
-                return
-            history_text = "🕒 Recent Searches\n━━━━━━━━━━━━━━\n"
-            for idx, (query, timestamp) in enumerate(history, 1):
-                time_str = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-                history_text += f"{idx}. '{query}' at {time_str}\n"
-            history_text += "━━━━━━━━━━━━━━"
-            await queue_message(callback_query.message.reply, history_text)
-            await log_to_channel(client, f"User {user_id} successfully viewed search history")
-
-        elif data in ("genbatch_add_files", "editbatch_add_files"):
-            await callback_query.answer("Please send the files you want to add to the batch! 📁", show_alert=True)
-
-        elif data in ("genbatch_sticker_panel", "editbatch_sticker_panel"):
-            await queue_message(
-                callback_query.message.reply,
-                "🎉 Sticker Panel! 🎈\nChoose a sticker to add some fun to your batch! 😊",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🎉 Party", callback_data="sticker_party")],
-                    [InlineKeyboardButton("🚀 Rocket", callback_data="sticker_rocket")],
-                    [InlineKeyboardButton("🌟 Star", callback_data="sticker_star")],
-                    [InlineKeyboardButton("🎁 Gift", callback_data="sticker_gift")],
-                    [InlineKeyboardButton("❌ Close Panel", callback_data="sticker_close")]
-                ])
-            )
-            await log_to_channel(client, f"Admin {user_id} opened sticker panel for batch")
-
-        elif data.startswith("sticker_"):
-            sticker_type = data.split("_")[1]
-            if sticker_type == "party":
-                await queue_message(callback_query.message.reply, "🎉 Let's celebrate with a party sticker! 🎈")
-                await log_to_channel(client, f"Admin {user_id} selected party sticker")
-            elif sticker_type == "rocket":
-                await queue_message(callback_query.message.reply, "🚀 Blast off with a rocket sticker! 🌌")
-                await log_to_channel(client, f"Admin {user_id} selected rocket sticker")
-            elif sticker_type == "star":
-                await queue_message(callback_query.message.reply, "🌟 Shine bright with a star sticker! ✨")
-                await log_to_channel(client, f"Admin {user_id} selected star sticker")
-            elif sticker_type == "gift":
-                await queue_message(callback_query.message.reply, "🎁 Unwrap a gift sticker! 🎀")
-                await log_to_channel(client, f"Admin {user_id} selected gift sticker")
-            elif sticker_type == "close":
-                await queue_message(callback_query.message.reply, "Sticker panel closed. Let's continue with the batch! 🚀")
-                await log_to_channel(client, f"Admin {user_id} closed sticker panel")
-            else:
-                await callback_query.answer("❌ Failed to select sticker: Invalid sticker selection. 😔", show_alert=True)
-                await log_to_channel(client, f"Admin {user_id} failed to select sticker: Invalid selection '{sticker_type}'")
-
-        elif data in ("genbatch_done", "editbatch_done") and user_id in admin_list and admin_pending_action.get(user_id) in ("genbatch_files", "editbatch_files"):
-            keyword = admin_batch_keywords[user_id]
-            num_files = len(batches[keyword]["msg_ids"]) if keyword in batches else 0
-            if admin_pending_action[user_id] == "genbatch_files":
-                await queue_message(callback_query.message.reply, f"✅ Batch '{keyword}' created successfully with {num_files} files! 🎉")
-                await log_to_channel(client, f"Admin {user_id} successfully completed batch creation for keyword '{keyword}' with {num_files} files")
-            else:
-                await queue_message(callback_query.message.reply, f"✅ Batch '{keyword}' updated successfully with {num_files} files! ✏️")
-                await log_to_channel(client, f"Admin {user_id} successfully completed batch edit for keyword '{keyword}' with {num_files} files")
-            admin_pending_action.pop(user_id, None)
-            admin_batch_keywords.pop(user_id, None)
+# Callback: Show the user's recent searches
+async def _cb_view_history(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    history = user_search_history.get(user_id, [])
+    if not history:
+        await queue_message(callback_query.message.reply, "❌ Failed to view history: You have no recent searches. 🕒")
+        await log_to_channel(client, f"User {user_id} failed to view search history: No recent searches")
+        return
+    history_text = "\n".join([
+        "🕒 Recent Searches",
+        "━━━━━━━━━━━━━━",
+        *(f"{idx}. '{query}' at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}" for idx, (query, timestamp) in enumerate(history, 1)),
+        "━━━━━━━━━━━━━━",
+    ])
+    await queue_message(callback_query.message.reply, history_text)
+    await log_to_channel(client, f"User {user_id} successfully viewed search history")
+
+# Callback: Remind the admin to send the batch files
+async def _cb_batch_add_files(client: Client, callback_query: CallbackQuery, data: str):
+    await callback_query.answer("Please send the files you want to add to the batch! 📁", show_alert=True)
+
+# Callback: Open the batch sticker panel
+async def _cb_sticker_panel(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    await queue_message(
+        callback_query.message.reply,
+        "🎉 Sticker Panel! 🎈\nChoose a sticker to add some fun to your batch! 😊",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎉 Party", callback_data="sticker_party")],
+            [InlineKeyboardButton("🚀 Rocket", callback_data="sticker_rocket")],
+            [InlineKeyboardButton("🌟 Star", callback_data="sticker_star")],
+            [InlineKeyboardButton("🎁 Gift", callback_data="sticker_gift")],
+            [InlineKeyboardButton("❌ Close Panel", callback_data="sticker_close")]
+        ])
+    )
+    await log_to_channel(client, f"Admin {user_id} opened sticker panel for batch")
 
-        elif data in ("genbatch_cancel", "editbatch_cancel") and user_id in admin_list and admin_pending_action.get(user_id) in ("genbatch_files", "editbatch_files"):
-            keyword = admin_batch_keywords.get(user_id)
-            if keyword in batches:
-                channel_id = batches[keyword]["channel_id"]
-                msg_ids = batches[keyword]["msg_ids"]
-                try:
-                    if channel_id and msg_ids:
-                        await client.delete_messages(channel_id, msg_ids)
-                        await log_to_channel(client, f"Admin {user_id} successfully cancelled batch '{keyword}' and deleted files in channel {channel_id}")
-                except Exception as e:
-                    await log_to_channel(client, f"Admin {user_id} failed to delete files during batch cancellation for '{keyword}': {str(e)}")
-                batches.pop(keyword, None)
-                batch_start_ids.pop(keyword, None)
-            await queue_message(callback_query.message.reply, "✅ Batch creation/editing cancelled successfully! 🗑️")
-            await log_to_channel(client, f"Admin {user_id} successfully cancelled batch for keyword '{keyword}'")
-            admin_pending_action.pop(user_id, None)
-            admin_batch_keywords.pop(user_id, None)
-
-        elif data.startswith("share_"):
-            _, channel_id, msg_id, _ = data.split("_", 3)
-            channel_id = int(channel_id)
-            msg_id = int(msg_id)
-            channel_id_str = str(channel_id)[4:] if str(channel_id).startswith("-100") else str(channel_id)
-            file_link = f"https://t.me/c/{channel_id_str}/{msg_id}"
-            shortened_link = await shorten_link(file_link)
-            await queue_message(
-                callback_query.message.reply,
-                f"🔗 Share this file with others:\n{shortened_link}"
-            )
-            await log_to_channel(client, f"User {user_id} successfully shared file link for message {msg_id} in channel {channel_id}")
-
-        elif data.startswith("get_"):
-            _, channel_id, msg_id, _ = data.split("_", 3)
-            channel_id = int(channel_id)
-            msg_id = int(msg_id)
-
-            # Log subscription check
-            if chat_id > 0 and force_sub_channels:
-                sub_status = await check_subscription(client, user_id, chat_id)
-                if not sub_status:
-                    buttons = [[InlineKeyboardButton("Join Channel", url=f"https://t.me/c/{str(ch)[4:]}")] for ch in force_sub_channels]
-                    buttons.append([InlineKeyboardButton("✅ I've Joined", callback_data="check_sub")])
-                    await queue_message(callback_query.message.reply, "❌ Failed to get file: Please join the required channels. 📢", reply_markup=InlineKeyboardMarkup(buttons))
-                    await log_to_channel(client, f"User {user_id} failed to get file in chat {chat_id}: Subscription check failed")
-                    return
-                await log_to_channel(client, f"User {user_id} passed subscription check in chat {chat_id}")
+# Callback: Sticker picked from the sticker panel
+async def _cb_sticker(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    sticker_type = data.split("_")[1]
+    if sticker_type == "party":
+        await queue_message(callback_query.message.reply, "🎉 Let's celebrate with a party sticker! 🎈")
+        await log_to_channel(client, f"Admin {user_id} selected party sticker")
+    elif sticker_type == "rocket":
+        await queue_message(callback_query.message.reply, "🚀 Blast off with a rocket sticker! 🌌")
+        await log_to_channel(client, f"Admin {user_id} selected rocket sticker")
+    elif sticker_type == "star":
+        await queue_message(callback_query.message.reply, "🌟 Shine bright with a star sticker! ✨")
+        await log_to_channel(client, f"Admin {user_id} selected star sticker")
+    elif sticker_type == "gift":
+        await queue_message(callback_query.message.reply, "🎁 Unwrap a gift sticker! 🎀")
+        await log_to_channel(client, f"Admin {user_id} selected gift sticker")
+    elif sticker_type == "close":
+        await queue_message(callback_query.message.reply, "Sticker panel closed. Let's continue with the batch! 🚀")
+        await log_to_channel(client, f"Admin {user_id} closed sticker panel")
+    else:
+        await callback_query.answer("❌ Failed to select sticker: Invalid sticker selection. 😔", show_alert=True)
+        await log_to_channel(client, f"Admin {user_id} failed to select sticker: Invalid selection '{sticker_type}'")
 
-            # Log verification status
-            verified_time = verified_users.get(user_id, 0)
-            now = time.time()
-            use_shortener = now - verified_time > VERIFICATION_DURATION
-            await log_to_channel(client, f"Verification status for user {user_id}: use_shortener={use_shortener}, verified_time={verified_time}, now={now}")
-
-            # Generate the file link
-            channel_id_str = str(channel_id)[4:] if str(channel_id).startswith("-100") else str(channel_id)
-            file_link = f"https://t.me/c/{channel_id_str}/{msg_id}"
-            await log_to_channel(client, f"Generated file link for user {user_id}: {file_link}")
-
-            if use_shortener:
-                file_link = await shorten_link(file_link)
-                await queue_message(
-                    callback_query.message.reply,
-                    f"ℹ️ Type movie name: hello and get your files like this\n🔗 Link generated with shortening:\n{file_link}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("⬇️ Download", url=file_link)],
-                        [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
-                        [InlineKeyboardButton("🔗 Share File", callback_data=f"share_{channel_id}_{msg_id}_{generate_dynamic_id()}")]
-                    ])
-                )
-                await log_to_channel(client, f"User {user_id} successfully requested shortened download link for message {msg_id} in channel {channel_id}")
-            else:
-                await queue_message(
-                    callback_query.message.reply,
-                    f"ℹ️ Type movie name: hello and get your files like this\n📥 Direct download link:\n{file_link}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("⬇️ Download", url=file_link)],
-                        [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
-                        [InlineKeyboardButton("🔗 Share File", callback_data=f"share_{channel_id}_{msg_id}_{generate_dynamic_id()}")]
-                    ])
-                )
-                await log_to_channel(client, f"User {user_id} successfully requested direct download link for message {msg_id} in channel {channel_id}")
-
-        elif data.startswith("page_"):
-            page_num = int(data.split("_")[1])
-            # Use cached results if available
-            now = time.time()
-            if chat_id not in search_cache or chat_id not in search_cache_expiry or now >= search_cache_expiry[chat_id]:
-                await callback_query.answer("❌ Failed to view page: Search results have expired. Please search again. 🔍", show_alert=True)
-                await log_to_channel(client, f"User {user_id} failed to view page {page_num}: Search results expired")
-                return
+# Callback: Finish creating/editing a batch
+async def _cb_batch_done(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    pending = admin_pending_action.get(user_id)
+    if user_id not in admin_list or pending not in ("genbatch_files", "editbatch_files"):
+        return
+    keyword = admin_batch_keywords[user_id]
+    num_files = len(batches[keyword]["msg_ids"]) if keyword in batches else 0
+    if pending == "genbatch_files":
+        await queue_message(callback_query.message.reply, f"✅ Batch '{keyword}' created successfully with {num_files} files! 🎉")
+        await log_to_channel(client, f"Admin {user_id} successfully completed batch creation for keyword '{keyword}' with {num_files} files")
+    else:
+        await queue_message(callback_query.message.reply, f"✅ Batch '{keyword}' updated successfully with {num_files} files! ✏️")
+        await log_to_channel(client, f"Admin {user_id} successfully completed batch edit for keyword '{keyword}' with {num_files} files")
+    admin_pending_action.pop(user_id, None)
+    admin_batch_keywords.pop(user_id, None)
+    save_batches()
 
-            results = search_cache[chat_id]
-            pages = [results[i:i + PAGE_SIZE] for i in range(0, len(results), PAGE_SIZE)]
-            if page_num < 1 or page_num > len(pages):
-                await callback_query.answer("❌ Failed to view page: Invalid page number. 😔", show_alert=True)
-                await log_to_channel(client, f"User {user_id} failed to view page {page_num}: Invalid page number")
-                return
+# Callback: Cancel a batch and delete its uploaded files
+async def _cb_batch_cancel(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    pending = admin_pending_action.get(user_id)
+    if user_id not in admin_list or pending not in ("genbatch_files", "editbatch_files"):
+        return
+    keyword = admin_batch_keywords.get(user_id)
+    if keyword in batches:
+        channel_id = batches[keyword]["channel_id"]
+        msg_ids = batches[keyword]["msg_ids"]
+        try:
+            if channel_id and msg_ids:
+                await client.delete_messages(channel_id, msg_ids)
+                await log_to_channel(client, f"Admin {user_id} successfully cancelled batch '{keyword}' and deleted files in channel {channel_id}")
+        except Exception as e:
+            await log_to_channel(client, f"Admin {user_id} failed to delete files during batch cancellation for '{keyword}': {str(e)}")
+        batches.pop(keyword, None)
+        batch_start_ids.pop(keyword, None)
+        unindex_batch_keyword(keyword)
+        save_batches()
+    await queue_message(callback_query.message.reply, "✅ Batch creation/editing cancelled successfully! 🗑️")
+    await log_to_channel(client, f"Admin {user_id} successfully cancelled batch for keyword '{keyword}'")
+    admin_pending_action.pop(user_id, None)
+    admin_batch_keywords.pop(user_id, None)
 
-            page = pages[page_num - 1]
-            buttons = []
-            for idx, file in enumerate(page, start=(page_num-1)*PAGE_SIZE + 1):
-                dyn_id = generate_dynamic_id()
-                button_text = f"{idx}. 📁 {file['file_name']} ({file['file_size']}MB)"
-                buttons.append([InlineKeyboardButton(button_text, callback_data=f"get_{file['channel_id']}_{file['msg_id']}_{dyn_id}")])
-            buttons.append([InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")])
-            nav_buttons = []
-            if page_num > 1:
-                nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"page_{page_num-1}"))
-            if page_num < len(pages):
-                nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"page_{page_num+1}"))
-            if nav_buttons:
-                buttons.append(nav_buttons)
-            await queue_message(
-                callback_query.message.edit,
-                f"📂 Search Results (Page {page_num}/{len(pages)}):",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            await log_to_channel(client, f"User {user_id} successfully viewed search results page {page_num}")
-
-        # Admin actions with password prompt
-        elif data in ["add_db", "add_sub", "stats", "remove_channel"] and user_id in admin_list:
-            admin_pending_action[user_id] = data
-            await queue_message(callback_query.message.reply, "🔒 Please enter the admin password to proceed:")
-            await log_to_channel(client, f"Admin {user_id} initiated action: {data}")
-
-        elif data.startswith("rm_db_") and user_id in admin_list:
-            admin_pending_action[user_id] = data
-            await queue_message(callback_query.message.reply, "🔒 Please enter the admin password to proceed:")
-            await log_to_channel(client, f"Admin {user_id} initiated remove DB channel action: {data}")
-
-        elif data.startswith("rm_sub_") and user_id in admin_list:
-            admin_pending_action[user_id] = data
-            await queue_message(callback_query.message.reply, "🔒 Please enter the admin password to proceed:")
-            await log_to_channel(client, f"Admin {user_id} initiated remove subscription channel action: {data}")
-
-        elif data.startswith("add_db_forward_") and user_id in admin_list:
-            admin_pending_action[user_id] = data
-            await queue_message(callback_query.message.reply, "🔒 Please enter the admin password to proceed:")
-            await log_to_channel(client, f"Admin {user_id} initiated add DB channel action: {data}")
-
-        elif data.startswith("add_sub_forward_") and user_id in admin_list:
-            admin_pending_action[user_id] = data
-            await queue_message(callback_query.message.reply, "🔒 Please enter the admin password to proceed:")
-            await log_to_channel(client, f"Admin {user_id} initiated add subscription channel action: {data}")
+# Callback: Send a shareable link for a file
+async def _cb_share(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    channel_id, msg_id = parse_file_callback(data)
+    file_link = message_link(channel_id, msg_id)
+    shortened_link = await shorten_link(file_link)
+    await queue_message(
+        callback_query.message.reply,
+        f"🔗 Share this file with others:\n{shortened_link}"
+    )
+    await log_to_channel(client, f"User {user_id} successfully shared file link for message {msg_id} in channel {channel_id}")
+
+# Callback: Send the download link for a search result
+async def _cb_get(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    chat_id = callback_query.message.chat.id
+    channel_id, msg_id = parse_file_callback(data)
+
+    # Log subscription check
+    if chat_id > 0 and force_sub_channels:
+        sub_status = await check_subscription(client, user_id, chat_id)
+        if not sub_status:
+            await queue_message(callback_query.message.reply, "❌ Failed to get file: Please join the required channels. 📢", reply_markup=subscription_keyboard())
+            await log_to_channel(client, f"User {user_id} failed to get file in chat {chat_id}: Subscription check failed")
+            return
+        await log_to_channel(client, f"User {user_id} passed subscription check in chat {chat_id}")
+
+    # Log verification status
+    verified_time = verified_users.get(user_id)  # Lapsed verifications have already expired
+    use_shortener = verified_time is None
+    await log_to_channel(client, f"Verification status for user {user_id}: use_shortener={use_shortener}, verified_time={verified_time}")
+
+    # Generate the file link
+    file_link = message_link(channel_id, msg_id)
+    await log_to_channel(client, f"Generated file link for user {user_id}: {file_link}")
+
+    if use_shortener:
+        file_link = await shorten_link(file_link)
+        await queue_message(
+            callback_query.message.reply,
+            f"ℹ️ Type movie name: hello and get your files like this\n🔗 Link generated with shortening:\n{file_link}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬇️ Download", url=file_link)],
+                [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
+                [InlineKeyboardButton("🔗 Share File", callback_data=file_callback("s", channel_id, msg_id))]
+            ])
+        )
+        await log_to_channel(client, f"User {user_id} successfully requested shortened download link for message {msg_id} in channel {channel_id}")
+    else:
+        await queue_message(
+            callback_query.message.reply,
+            f"ℹ️ Type movie name: hello and get your files like this\n📥 Direct download link:\n{file_link}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬇️ Download", url=file_link)],
+                [InlineKeyboardButton("📖 How to Download", url="https://t.me/c/2323164776/7")],
+                [InlineKeyboardButton("🔗 Share File", callback_data=file_callback("s", channel_id, msg_id))]
+            ])
+        )
+        await log_to_channel(client, f"User {user_id} successfully requested direct download link for message {msg_id} in channel {channel_id}")
 
+# Callback: Page through user activity statistics
+async def _cb_user_stats(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    if user_id not in admin_list:
+        return
+    page_num = int(data.split("_")[1])
+    if not _user_stats_snapshot:  # Buttons from before a restart
+        refresh_user_stats_snapshot()
+    start = (page_num - 1) * USER_STATS_PAGE_SIZE
+    rows = _user_stats_snapshot[start:start + USER_STATS_PAGE_SIZE]
+    stats_text, markup = render_user_stats(rows, page_num, len(_user_stats_snapshot))
+    await queue_message(callback_query.message.edit, stats_text, reply_markup=markup)
+    await log_to_channel(client, f"Admin {user_id} successfully viewed user activity statistics page {page_num}")
+
+# Callback: Show another page of search results
+async def _cb_page(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    chat_id = callback_query.message.chat.id
+    page_num = int(data.split("_")[1])
+    # Use the keyboards prebuilt at search time if available
+    page_markups = search_pages_cache.get(chat_id)
+    if page_markups is None:
+        await callback_query.answer("❌ Failed to view page: Search results have expired. Please search again. 🔍", show_alert=True)
+        await log_to_channel(client, f"User {user_id} failed to view page {page_num}: Search results expired")
+        return
+
+    npages = len(page_markups)
+    if page_num < 1 or page_num > npages:
+        await callback_query.answer("❌ Failed to view page: Invalid page number. 😔", show_alert=True)
+        await log_to_channel(client, f"User {user_id} failed to view page {page_num}: Invalid page number")
+        return
+
+    await queue_message(
+        callback_query.message.edit,
+        f"📂 Search Results (Page {page_num}/{npages}):",
+        reply_markup=page_markups[page_num - 1]
+    )
+    await log_to_channel(client, f"User {user_id} successfully viewed search results page {page_num}")
+
+# Callback: Ask an admin for the password before a protected action
+async def _cb_admin_prompt(client: Client, callback_query: CallbackQuery, data: str):
+    user_id = callback_query.from_user.id
+    if user_id not in admin_list:
+        return
+    label = ADMIN_PROMPT_EXACT.get(data) or next(label for prefix, label in ADMIN_PROMPT_PREFIXES.items() if data.startswith(prefix))
+    admin_pending_action[user_id] = data
+    await queue_message(callback_query.message.reply, PASSWORD_PROMPT)
+    logger.info("Admin %s initiated %s: %s", user_id, label, data)
+    await log_to_channel(client, ADMIN_PROMPT_LOG.format_map({"uid": user_id, "label": label, "data": data}))
+
+# Callback handlers, by exact callback data and by callback data prefix (most frequent first)
+_CALLBACK_EXACT: Dict[str, Callable[[Client, CallbackQuery, str], Awaitable[None]]] = {
+    "check_sub": _cb_check_sub,
+    "view_history": _cb_view_history,
+    "genbatch_add_files": _cb_batch_add_files,
+    "editbatch_add_files": _cb_batch_add_files,
+    "genbatch_sticker_panel": _cb_sticker_panel,
+    "editbatch_sticker_panel": _cb_sticker_panel,
+    "genbatch_done": _cb_batch_done,
+    "editbatch_done": _cb_batch_done,
+    "genbatch_cancel": _cb_batch_cancel,
+    "editbatch_cancel": _cb_batch_cancel,
+    **{key: _cb_admin_prompt for key in ADMIN_PROMPT_EXACT},
+}
+_CALLBACK_PREFIXES: Tuple[Tuple[str, Callable[[Client, CallbackQuery, str], Awaitable[None]]], ...] = (
+    ("g:", _cb_get),
+    ("page_", _cb_page),
+    ("s:", _cb_share),
+    ("get_", _cb_get),  # Buttons sent before callback data was packed
+    ("share_", _cb_share),
+    ("sticker_", _cb_sticker),
+    ("ustats_", _cb_user_stats),
+    *((prefix, _cb_admin_prompt) for prefix in ADMIN_PROMPT_PREFIXES),
+)
+
+# Callback query handler
+@app.on_callback_query()
+async def handle_callbacks(client: Client, callback_query: CallbackQuery):
+    data = callback_query.data
+    user_id = callback_query.from_user.id
+
+    try:
+        handler = _CALLBACK_EXACT.get(data)
+        if handler is None:
+            handler = next((fn for prefix, fn in _CALLBACK_PREFIXES if data.startswith(prefix)), None)
+        if handler is not None:
+            await handler(client, callback_query, data)
     except Exception as e:
         await log_to_channel(client, f"Error in callback for user {user_id}: {str(e)}")
-        logger.error(f"Error in callback: {e}")
+        logger.error("Error in callback: %s", e)
         await callback_query.answer(f"❌ Failed to process callback: An error occurred - {str(e)}. 😓", show_alert=True)
 
 # Handle forwarded message from admin (strictly for admin)
 @app.on_message(filters.private & filters.forwarded)
 async def add_channel(client: Client, message: Message):
     user_id = message.from_user.id
+    _reply = message.reply
     if user_id not in admin_list:
-        await queue_message(message.reply, "❌ Failed to add channel: This action is restricted to admins only. 🚫")
+        await queue_message(_reply, "❌ Failed to add channel: This action is restricted to admins only. 🚫")
         await log_to_channel(client, f"User {user_id} attempted to forward a message for admin action")
         return
 
     chat = message.forward_from_chat
     if not chat:
-        await queue_message(message.reply, "❌ Failed to add channel: Invalid forwarded message. 😔")
+        await queue_message(_reply, "❌ Failed to add channel: Invalid forwarded message. 😔")
         await log_to_channel(client, f"Admin {user_id} failed to add channel: Invalid forwarded message")
         return
+    cid = chat.id
 
-    if not await check_bot_privileges(client, chat.id):
-        await queue_message(message.reply, f"❌ Failed to add channel: Bot must be an admin in the channel {chat.id} with sufficient privileges. ⚙️")
-        await log_to_channel(client, f"Admin {user_id} failed to add channel {chat.id}: Bot lacks admin privileges")
+    if not await check_bot_privileges(client, cid):
+        await queue_message(_reply, f"❌ Failed to add channel: Bot must be an admin in the channel {cid} with sufficient privileges. ⚙️")
+        await log_to_channel(client, f"Admin {user_id} failed to add channel {cid}: Bot lacks admin privileges")
         return
 
-    if user_id in admin_pending_action and admin_pending_action[user_id] == "set_logchannel":
-        global log_channel
-        log_channel = chat.id
+    if admin_pending_action.get(user_id) == "set_logchannel":
+        _state["log_channel"] = cid
+        _log_msg_ids.clear()
         admin_pending_action.pop(user_id, None)
-        await queue_message(message.reply, f"✅ Log channel {chat.id} set successfully! 📝")
-        await log_to_channel(client, f"Admin {user_id} successfully set log channel to {chat.id}")
+        await queue_message(_reply, f"✅ Log channel {cid} set successfully! 📝")
+        await log_to_channel(client, f"Admin {user_id} successfully set log channel to {cid}")
         return
 
     await queue_message(
-        message.reply,
+        _reply,
         "Is this a DB channel or a subscription channel? 📚📢",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("DB Channel", callback_data=f"add_db_forward_{chat.id}")],
-            [InlineKeyboardButton("Subscription Channel", callback_data=f"add_sub_forward_{chat.id}")]
-        ])
+        reply_markup=_channel_kind_kb(cid)
     )
-    await log_to_channel(client, f"Admin {user_id} forwarded a message to add channel {chat.id}")
-
-# Handle broadcast message after password verification
-@app.on_message(filters.private & filters.text & filters.regex(r"^(?!/start$|/help$|/feedback$|add_db$|add_sub$|genbatch$|editbatch$|caption$|channels$|stats$|user_stats$|broadcast$|remove_channel$|admin_list$|set_logchannel$|set_rate_limit$|clear_logs$).+"))
+    await log_to_channel(client, f"Admin {user_id} forwarded a message to add channel {cid}")
+
+# Filter: Only admins with a pending broadcast reach the broadcast handler
+@filters.create
+async def is_broadcast_pending(_, __, message: Message) -> bool:
+    user = message.from_user
+    return user is not None and user.id in admin_list and admin_pending_action.get(user.id) == "broadcast_message"
+
+# Filter: Text that isn't a bare command word (a single set lookup instead of a lookahead regex)
+@filters.create
+async def is_broadcast_text(_, __, message: Message) -> bool:
+    text = message.text
+    return bool(text) and text not in BROADCAST_BLOCKED_TEXTS
+
+# Handle broadcast message after password verification (group -1 so it runs before handle_query)
+@app.on_message(filters.private & filters.text & is_broadcast_pending & is_broadcast_text, group=-1)
 async def handle_broadcast_message(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id not in admin_list or user_id not in admin_pending_action or admin_pending_action[user_id] != "broadcast":
+    # Consume the pending action in one lookup; re-check in case it changed after filtering
+    if admin_pending_action.pop(user_id, None) != "broadcast_message":
         return
 
     broadcast_message = message.text.strip()
-    admin_pending_action.pop(user_id, None)
 
     # Send broadcast to all DB and subscription channels
-    all_channels = db_channels.union(force_sub_channels)
-    successful_channels = 0
-    for channel_id in all_channels:
-        try:
-            await queue_message(client.send_message, channel_id, f"📢 Broadcast Message:\n{broadcast_message}")
-            successful_channels += 1
-            await log_to_channel(client, f"Broadcast sent to channel {channel_id}: {broadcast_message}")
-            logger.info(f"Broadcast sent to channel {channel_id}")
-        except Exception as e:
-            await log_to_channel(client, f"Failed to send broadcast to channel {channel_id}: {str(e)}")
-            logger.error(f"Error sending broadcast to channel {channel_id}: {e}")
+    all_channels = get_all_channels()
+    total = len(all_channels)
+    text = f"📢 Broadcast Message:\n{broadcast_message}"
+    # Each channel's send runs on its own destination worker; cap how many hit Telegram at once
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    async def send_one(channel_id: int):
+        async with semaphore:
+            return await client.send_message(
+                channel_id, text,
+                disable_notification=BROADCAST_SILENT, disable_web_page_preview=BROADCAST_SILENT
+            )
 
-    if successful_channels == len(all_channels):
-        await queue_message(message.reply, f"✅ Broadcast sent successfully to {len(all_channels)} channels! 📣")
-        await log_to_channel(client, f"Admin {user_id} successfully broadcasted message to {len(all_channels)} channels")
+    pending = []
+    for channel_id in all_channels:
+        pending.append((channel_id, await enqueue(channel_id, send_one, channel_id)))
+    outcomes = await asyncio.gather(*(future for _, future in pending), return_exceptions=True)
+
+    # Collect per-channel outcomes and report them once instead of logging every send
+    results = [(channel_id, str(outcome) if isinstance(outcome, Exception) else None) for (channel_id, _), outcome in zip(pending, outcomes)]
+    ok = [channel_id for channel_id, error in results if error is None]
+    fail = [(channel_id, error) for channel_id, error in results if error]
+    logger.info("Broadcast by %s: %d/%d ok", user_id, len(ok), total)
+    await log_to_channel(client, f"Broadcast by {user_id}: {len(ok)}/{total} ok" + (f"; failures: {fail[:20]}" if fail else ""))
+
+    if len(ok) == total:
+        await queue_message(message.reply, f"✅ Broadcast sent successfully to {total} channels! 📣")
     else:
-        await queue_message(message.reply, f"⚠️ Broadcast sent to {successful_channels}/{len(all_channels)} channels. Check logs for details. 📣")
-        await log_to_channel(client, f"Admin {user_id} partially broadcasted message: {successful_channels}/{len(all_channels)} channels successful")
+        await queue_message(message.reply, f"⚠️ Broadcast sent to {len(ok)}/{total} channels. Check logs for details. 📣")
+    # Handled here; don't let handle_query treat the text as a search
+    message.stop_propagation()
+
+# Run bot until stopped, then release shared resources
+async def main():
+    load_batches()
+    await app.start()
+    start_sender_workers()
+    _background_tasks.append(asyncio.create_task(_janitor()))
+    keep_alive_runner = None
+    logger.info("Starting File Request Bot 🚀")
+    try:
+        # Uptime pings are only served when the host assigns a port (web services); workers don't need them
+        if KEEP_ALIVE_PORT:
+            keep_alive_runner = await keep_alive.run(int(KEEP_ALIVE_PORT))
+        await idle()
+    finally:
+        if keep_alive_runner is not None:
+            await keep_alive_runner.cleanup()
+        await cancel_pending_tasks()
+        await stop_sender_workers()
+        await app.stop()
+        await close_http_session()
 
-# Run bot
 if __name__ == "__main__":
-    logger.info("Starting File Request Bot 🚀")
-    app.run()
+    app.run(main())
@@ -1,14 +1,20 @@
-from flask import Flask
+from aiohttp import web
 
-app = Flask(__name__)
+async def home(request):
+    return web.Response(text="Bot is alive!")
 
-@app.route('/')
-def home():
-    return "Bot is alive!"
+async def ping(request):
+    return web.Response(text="Pong!")
 
-@app.route('/ping')
-def ping():
-    return "Pong!"
+app = web.Application()
+app.add_routes([web.get('/', home), web.get('/ping', ping)])
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+async def run(port: int = 8080) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, '0.0.0.0', port).start()
+    except BaseException:
+        await runner.cleanup()
+        raise
+    return runner